@@ -0,0 +1,352 @@
+'''
+Micro-benchmarks for the hot spots of the extraction and dataset pipeline.
+
+Each benchmark is a subcommand, e.g.
+
+    $ python3 src/benchmarks.py parse-line --dumpfile data/enwiktionary-20220701-pages-articles-multistream.xml
+'''
+
+import os
+import random
+import logging
+import tempfile
+import time
+
+import sys
+sys.path.append('src')
+
+# definition lines used when no dump file is given
+sample_lines = [
+    "# {{lb|ms|Indonesia}} [[free]]",
+    "# [[dog]], [[hound]]",
+    "# [[free]], [[gratis]]",
+    "# to [[realize]] (come to comprehend)",
+    "# {{lb|pt|Christianity}} {{l|en|Holy Ghost}}; {{l|en|Holy Spirit}} {{gloss|one of the three figures of the Holy Trinity}}",
+    "# {{place|pt|municipality/state capital|s/Santa Catarina|c/Brazil|t=Florianópolis}}",
+    "# {{female equivalent of|es|hermano|gloss=sister}}",
+    "# {{ISO 639|2&3|ca|Catalan}}",
+    "# {{vern|African golden cat}} ({{taxlink|Caracal aurata|species|ver=210608}})",
+    "# {{form of|ko|honorific|장모||[[mother-in-law]], wife's mother}}",
+    "# {{hanja form of|결가부좌|lotus position}}",
+    "# {{lb|en|historical}} The smallest unit of currency in South Asia, equivalent to {{frac|1|192}} of a [[rupee]] or {{frac|1|12}} of an [[anna]].",
+    "# {{lb|de|with {{m|de|von}}}} [[free]] of {{gloss|not containing or unaffected by}}",
+    "# {{lb|es|Belize}} to [[realize]] (come to comprehend)<ref name=\"hagerty\">{{cite book |title=Belize |year=1996}}</ref>",
+    "# ''{{w|Mencius (book)|Mencius}}'' {{gloss|one of the {{w|Four Books and Five Classics|Four Books}} of [[Confucianism]]}}",
+    "# {{lb|en|Australian rules football|Gaelic football}} {{abbreviation of|en|free kick}}",
+    "# {{es-verb form of|mood=indicative|tense=present|num=s|pers=3|ending=ar|hablar}}",
+    "# {{inflection of|de|frei||str|nom|m|s}}",
+    "# {{plural of|es|perro}}",
+    "# {{alternative form of|en|colour}}",
+    "#: {{syn|ru|же́нщина|t1=woman|ба́ба|;|t2=older woman|q2=informal}}",
+    "#: {{ux|es|Es un perro '''libre'''.|It is a free dog.}}",
+    "#* {{quote-book|es|year=1605|author=Miguel de Cervantes|title=Don Quijote|passage=En un lugar de la Mancha}}",
+    "# {{n-g|Used to form the plural}}",
+    "# {{lb|ko|formal}} [[house]], [[home]]; [[residence]]",
+    "# {{given name|es|male}}",
+    "# (''intransitive'') to [[run]], to [[jog]]",
+    "# a [[piece]]/[[scrap]]/[[slice]] (of an object); [[shard]], [[sliver]]",
+]
+
+
+def _definition_lines(dumpfile, num_lines):
+    '''
+    Return the first `num_lines` definition lines of `dumpfile`, or `sample_lines` if no dump is given.
+    '''
+    if not dumpfile:
+        return sample_lines
+    from extract import iterate_pages, group_squiggles
+    lines = []
+    for title, text, _, _ in iterate_pages(dumpfile):
+        lines.extend(line for line in group_squiggles(text).split('\n') if line.startswith('#'))
+        if len(lines) >= num_lines:
+            break
+    return lines[:num_lines]
+
+
+def _time_per_call(f, args, repeat):
+    '''
+    Return the best time (over `repeat` runs) of calling `f` once on every element of `args`, divided by `len(args)`.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            f(arg)
+        best = min(best, time.perf_counter() - start)
+    return best / len(args)
+
+
+def _elif_chain_classifier():
+    '''
+    Return a copy of the if/elif chain that selected the processing of a template in `extract.parse_line`
+    before the handler table of `extract.classify_template`,
+    returning the handler that the table selects for the same branch instead of running the branch.
+    '''
+    import extract
+    handlers = extract.template_handlers
+    place, initialism_of, w, link, zh_l, zh_classifier = (handlers[name] for name in ['place', 'initialism of', 'w', 'l', 'zh-l', 'zh-classifier'])
+    iso_639, vern, taxlink, lang, name_translit = (handlers[name] for name in ['iso 639', 'vern', 'taxlink', 'lang', 'name translit'])
+    hanja_form_of, alt_of, form_of = (handlers[name] for name in ['hanja form of', 'alt of', 'form of'])
+    non_gloss = extract.inline_arg(1)
+    ignore_template, frac, inflection_of = extract.ignore_template, extract.frac, extract.inflection_of
+    conjugation_table, reverse_translation = extract.conjugation_table, extract.reverse_translation
+    semantic_relation, unknown_template = extract.semantic_relation, extract.unknown_template
+
+    def classify(nodename):
+        if nodename in ['place']:
+            return place
+        elif nodename in ['place']:
+            return place
+        elif nodename in ['initialism of']:
+            return initialism_of
+        elif nodename in ['w', 'unsupported']:
+            return w
+        elif nodename in ['m', 'mention', 'l', 'link', 'l-lite', 'm-lite']:
+            return link
+        elif nodename in ['zh-l']:
+            return zh_l
+        elif nodename in ['zh-classifier', 'th-l', 'zh-original', 'zh-abbrev']:
+            return zh_classifier
+        elif 'non' in nodename and 'gloss' in nodename:
+            return non_gloss
+        elif nodename.endswith('usex') or nodename in [
+                'rfdef', 'rfclarify', 'rfex', 'attention',
+                'Latn-def', 'Latn-def-lite', 'Latn-def',
+                'latn-def', 'latn-def-lite', 'latn-def',
+                'gl', 'gloss', 'gloss-lite',
+                'lb', 'lbl', 'label', 'tlb', 'term-label',
+                'ng', 'n-g', 'ngd', 'n-g-lite',
+                'q', 'qf', 'qual', 'qualifier', 'q-lite', 'qualifier-lite', 'i',
+                'c', 'C', 'topics', 'top',
+                'given name', 'surname',
+                'defdate',
+                '+obj',
+                'cln',
+                'only used in', 'used in phrasal verbs',
+                'term-label',
+                'ja-def', 'ja-x', 'ko-x',
+                'mul-kangxi radical-def',
+                'zh-mw', 'zh-div',
+                'short for',
+                'bond credit rating',
+                'taxon',
+                'anchor', 'senseid', 'rfd-sense', 'rfv-sense', 'sense', 'sense-lite',
+                ',', 'isbn', '...', 'nbsp', 'mono', 'monospace',
+                'ux', 'uxi', 'zh-x', 'ja-usex', 'ko-usex', 'suffixusex', 'usex', 'th-x', 'th-usex', 'hi-x',
+                'quote', 'quote-book', 'quote-journal', 'Q', 'quote-text', 'quote-web', 'quote-newsgroup',
+                'coi', '†', 'zh-obsolete',
+                ] or 'quote' in nodename or 'rq:' in nodename:
+            return ignore_template
+        elif nodename in ['iso 639', 'iso 3166']:
+            return iso_639
+        elif nodename in ['vern']:
+            return vern
+        elif nodename in ['taxlink']:
+            return taxlink
+        elif nodename in ['frac']:
+            return frac
+        elif nodename in ['lang']:
+            return lang
+        elif nodename in ['name translit']:
+            return name_translit
+        elif nodename in ['hanja form of', 'ko-hanja form of']:
+            return hanja_form_of
+        elif nodename in ['ca-verb form of', 'nl-verb form of']:
+            return ignore_template
+        elif nodename in [
+                'alt of', 'altform', 'alt form', 'alternative form of',
+                'nonstandard form of', 'standard form of',
+                'synonym of', 'syn of',
+                'abbreviation of', 'clipping of',
+                'female equivalent of', 'femeq',
+                'cognate', 'cog',
+                ]:
+            return alt_of
+        elif nodename in ['form of']:
+            return form_of
+        elif ((len(nodename)>5 and nodename[2] == '-') or
+              nodename.endswith(' of') or
+              nodename.endswith('-of') or
+              nodename.endswith('-alt') or
+              nodename.endswith(' sp') or
+              nodename.startswith('alt') or
+              '-form-' in nodename or
+              nodename in [
+                'clipping',
+                'missp',
+                'fr-post-1990',
+                ]):
+            return inflection_of
+        elif '-conj' in nodename:
+            return conjugation_table
+        elif nodename in ['t', 't+', 'tt', 'tt+', 't-check', 't-simple']:
+            return reverse_translation
+        elif nodename in ['syn', 'synonyms', 'cot', 'coordinate terms', 'ant', 'antonym', 'antonyms', 'holonyms', 'hypernyms', 'hypo', 'hyponyms', 'holonyms', 'holo', 'hyper', 'impf', 'imperfectives', 'meronyms', 'inline alt forms', 'perfectives', 'pf', 'troponyms']:
+            return semantic_relation
+        else:
+            return unknown_template
+    return classify
+
+
+def parse_line(*, dumpfile=None, num_lines:int=10000, repeat:int=3):
+    '''
+    Measure the per-line cost of `extract.parse_line`, and of classifying template names
+    with the if/elif chain that `extract.classify_template` replaced, and with its rules with and without memoization.
+
+    :dumpfile: take the definition lines from this dump instead of the built-in sample
+    :num_lines: number of definition lines to take from the dump
+    :repeat: report the best of this many runs
+    '''
+    import extract
+    lines = _definition_lines(dumpfile, num_lines)
+    print(f'parse_line:            {1e6*_time_per_call(extract.parse_line, lines, repeat):10.2f} us/line ({len(lines)} lines)')
+
+    stats = extract.ExtractStats()
+    for line in lines:
+        extract.parse_line(line, fast_path=False, stats=stats)
+    names = list(stats.template_names.elements())
+    elif_chain = _elif_chain_classifier()
+    assert all(elif_chain(name) is extract.classify_template(name) for name in names)
+    uncached = extract.classify_template.__wrapped__
+    print(f'classify (elif chain): {1e6*_time_per_call(elif_chain, names, repeat):10.2f} us/template ({len(names)} templates)')
+    print(f'classify (rules):      {1e6*_time_per_call(uncached, names, repeat):10.2f} us/template')
+    print(f'classify (memoized):   {1e6*_time_per_call(extract.classify_template, names, repeat):10.2f} us/template')
+
+
+def _write_synthetic_vec(path, num_lines, dim):
+    '''
+    Write a fastText `.vec` file with `num_lines` random words and `dim` dimensional vectors.
+    '''
+    rng = random.Random(0)
+    vector = ' '.join(f'{rng.uniform(-1, 1):.4f}' for _ in range(dim))
+    with open(path, 'wt', encoding='utf-8') as fout:
+        fout.write(f'{num_lines} {dim}\n')
+        for i in range(num_lines):
+            fout.write(f'w{rng.getrandbits(32):08x}{i} {vector}\n')
+
+
+def read_vocab(*, vec_path=None, num_lines:int=2000000, dim:int=300, maxn:int=200000):
+    '''
+    Compare reading the words of a `.vec` file line by line with `utils.read_vocab`.
+
+    :vec_path: the `.vec` file to read; by default a synthetic file is generated in a temporary directory
+    :num_lines: number of lines of the synthetic file
+    :dim: dimension of the vectors of the synthetic file
+    :maxn: vocabulary size for the benchmark with an early exit
+    '''
+    import utils
+    tmpdir = None
+    if not vec_path:
+        tmpdir = tempfile.TemporaryDirectory()
+        vec_path = os.path.join(tmpdir.name, 'synthetic.vec')
+        logging.info(f'writing {vec_path}')
+        _write_synthetic_vec(vec_path, num_lines, dim)
+
+    def split_lines(maxn=None):
+        words = []
+        with open(vec_path, encoding='utf-8', errors='ignore') as fin:
+            for i, line in enumerate(fin):
+                words.append(line.split()[0])
+                if maxn and i >= maxn:
+                    break
+        return words
+
+    for name, f in [
+            ('line.split()', lambda: split_lines()),
+            ('read_vocab', lambda: list(utils.read_vocab(vec_path, skip_header=False))),
+            ('line.split(), maxn', lambda: split_lines(maxn)),
+            ('read_vocab, maxn', lambda: list(utils.read_vocab(vec_path, maxn+1, skip_header=False))),
+            ]:
+        start = time.perf_counter()
+        words = f()
+        print(f'{name:22} {time.perf_counter()-start:8.2f} s ({len(words)} words)')
+
+    if tmpdir:
+        tmpdir.cleanup()
+
+
+def pair_lines(*, num_lines:int=200000, escaped_fraction:float=0.05, repeat:int=3):
+    '''
+    Compare formatting and parsing pair lines with `utils` and with character loops.
+
+    :num_lines: number of synthetic pairs
+    :escaped_fraction: fraction of the pairs with a word that needs escapes
+    :repeat: number of times to repeat each measurement
+    '''
+    import io
+    import utils
+
+    def escape_chars(s, badchars=':,\\', escape='\\'):
+        ret = []
+        for c in s:
+            if c in badchars:
+                ret.append(escape)
+            ret.append(c)
+        return ''.join(ret)
+
+    def pair_to_line_chars(srcs, tgts):
+        return ','.join([escape_chars(src) for src in srcs]) + ':' + ','.join([escape_chars(tgt) for tgt in tgts])
+
+    def line_to_pair_chars(line):
+        src_line, tgt_line = utils._split_unescape_chars(line, ':', unescape=False)
+        return [utils._split_unescape_chars(src_line, ','), utils._split_unescape_chars(tgt_line, ',')]
+
+    rng = random.Random(0)
+    words = ['feliz', 'felices', 'happy', 'perro', 'dog', 'hound', 'casa', 'house', 'home', 'Holy Spirit']
+    pairs = []
+    for i in range(num_lines):
+        srcs = rng.sample(words, 2)
+        tgts = rng.sample(words, 3)
+        if rng.random() < escaped_fraction:
+            tgts[0] = 'this, is: a test'
+        pairs.append((srcs, tgts))
+    text = ''.join(utils.pairs_to_lines(pairs))
+    assert [ line_to_pair_chars(line.rstrip('\n')) for line in io.StringIO(text) ] == list(utils.lines_to_pairs(io.StringIO(text)))
+
+    for name, f in [
+            ('format (char loop)', lambda _: [ pair_to_line_chars(srcs, tgts) for srcs, tgts in pairs ]),
+            ('format (utils)', lambda _: list(utils.pairs_to_lines(pairs))),
+            ('parse (char loop)', lambda _: [ line_to_pair_chars(line.rstrip('\n')) for line in io.StringIO(text) ]),
+            ('parse (utils)', lambda _: list(utils.lines_to_pairs(io.StringIO(text)))),
+            ]:
+        elapsed = _time_per_call(f, [None], repeat)
+        print(f'{name:20} {elapsed:8.3f} s {num_lines/elapsed/1e3:10.1f} k lines/s')
+
+
+def bli_eval(*, num_words:int=200000, dim:int=300, num_queries:int=1500, csls_k:int=10, block_size:int=4096):
+    '''
+    Measure the throughput of `evaluate_bli` on random source and English embeddings.
+
+    :num_words: vocabulary size of both languages
+    :dim: dimension of the embeddings
+    :num_queries: number of source words of the test dictionary
+    :csls_k: number of neighbors of the CSLS penalties
+    :block_size: number of rows and columns of the blocked similarity matrices
+    '''
+    import numpy as np
+    import evaluate_bli
+    rng = np.random.default_rng(0)
+    words = [ f'w{i}' for i in range(num_words) ]
+    src = rng.standard_normal((num_words, dim), dtype=np.float32)
+    tgt = rng.standard_normal((num_words, dim), dtype=np.float32)
+    translations = { f'w{i}': {f'w{i}'} for i in rng.choice(num_words, num_queries, replace=False) }
+    evaluator = evaluate_bli.Evaluator(words, src, words, tgt, csls_k=csls_k, block_size=block_size)
+
+    def report(name, elapsed, num_pairs):
+        print(f'{name:16} {elapsed:8.2f} s {num_pairs/elapsed/1e6:10.1f} M similarities/s {2*dim*num_pairs/elapsed/1e9:8.1f} GFLOP/s')
+
+    start = time.perf_counter()
+    evaluator.evaluate(translations, methods=('nn',))
+    report('nn', time.perf_counter()-start, num_queries*num_words)
+    start = time.perf_counter()
+    evaluator.tgt_penalty()
+    report('csls penalties', time.perf_counter()-start, num_words*num_words)
+    start = time.perf_counter()
+    evaluator.evaluate(translations, methods=('csls',))
+    report('csls', time.perf_counter()-start, num_queries*num_words)
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run([parse_line, read_vocab, pair_lines, bli_eval])
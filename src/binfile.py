@@ -0,0 +1,147 @@
+'''
+Helpers for the memory mapped binary files of this project
+(the binary intermediate files of `intermediate.py`, the rank indexes of `rank_index.py`,
+and the reverse translation indexes of `reverse_index.py`).
+
+A file starts with 8 magic bytes that identify its type and version,
+followed by sections that each start at a multiple of 8 bytes.
+All integers are stored little endian.
+'''
+
+import sys
+import mmap
+import zlib
+from array import array
+
+
+def padding(size):
+    '''
+    Return the zero bytes that bring a section of `size` bytes to a multiple of 8 bytes.
+    '''
+    return b'\x00' * (-size % 8)
+
+
+def write_array(fout, values):
+    '''
+    Write the `array.array` `values` to `fout` as a section.
+    '''
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    data = values.tobytes()
+    fout.write(data)
+    fout.write(padding(len(data)))
+
+
+def hash_table(keys):
+    '''
+    Return an open addressing hash table (an `array.array` of uint32 slots) of `keys`, a list of bytes.
+    A slot holds the index of a key plus one, and zero marks an empty slot;
+    the slot of a key is found by its crc32 followed by linear probing.
+    When a key appears several times, the table holds its last index.
+
+    >>> keys = [b'the', b'of', b'and']
+    >>> slots = hash_table(keys)
+    >>> [ hash_lookup(slots, key, keys.__getitem__) for key in [b'of', b'and', b'cat'] ]
+    [1, 2, None]
+    '''
+    num_slots = 1
+    while num_slots < 2*len(keys):
+        num_slots *= 2
+    mask = num_slots - 1
+    slots = array('I', bytes(4*num_slots))
+    for i, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while slots[slot] and keys[slots[slot]-1] != key:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+    return slots
+
+
+def hash_lookup(slots, key, key_at):
+    '''
+    Return the index of the bytes `key` in the hash table `slots` built by `hash_table`, or None.
+    `key_at(i)` returns the key with index `i`.
+    '''
+    mask = len(slots) - 1
+    slot = zlib.crc32(key) & mask
+    while True:
+        i = slots[slot]
+        if not i:
+            return None
+        if key_at(i-1) == key:
+            return i-1
+        slot = (slot + 1) & mask
+
+
+def has_magic(path, magic):
+    '''
+    Return True if the file `path` starts with `magic`.
+    '''
+    with open(path, 'rb') as fin:
+        return fin.read(len(magic)) == magic
+
+
+class MappedFile:
+    '''
+    A read-only memory map of a file that starts with `magic`.
+    The sections are read in the order they were written with `read_array` and `read_bytes`.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'example')
+    >>> with open(path, 'wb') as fout:
+    ...     _ = fout.write(b'EXAMPLE\\x01')
+    ...     write_array(fout, array('I', [1, 2, 3]))
+    ...     _ = fout.write(b'abc')
+    >>> with MappedFile(path, b'EXAMPLE\\x01') as f:
+    ...     list(f.read_array('I', 3)), bytes(f.read_bytes())
+    ([1, 2, 3], b'abc')
+    '''
+
+    def __init__(self, path, magic):
+        with open(path, 'rb') as fin:
+            self.mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(magic)] != magic:
+            self.mmap.close()
+            raise ValueError(f'{path} does not start with {magic}')
+        self.view = memoryview(self.mmap)
+        self.views = []
+        self.offset = len(magic) + len(padding(len(magic)))
+
+    def read_array(self, typecode, length):
+        '''
+        Return the next section as a sequence of `length` values of the `array.array` type `typecode`.
+        On little endian machines this is a view into the memory map, and nothing is copied.
+        '''
+        size = array(typecode).itemsize * length
+        values = self.view[self.offset:self.offset+size].cast(typecode)
+        self.offset += size + len(padding(size))
+        if sys.byteorder != 'little':
+            values = array(typecode, values)
+            values.byteswap()
+        else:
+            self.views.append(values)
+        return values
+
+    def read_bytes(self, length=None):
+        '''
+        Return the next `length` bytes (by default, the rest of the file) as a memoryview.
+        '''
+        end = len(self.mmap) if length is None else self.offset + length
+        data = self.view[self.offset:end]
+        self.offset = end + len(padding(end - self.offset))
+        self.views.append(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views.clear()
+        self.view.release()
+        self.mmap.close()
@@ -0,0 +1,235 @@
+'''
+Memory mapped embedding matrices of fastText `.vec` files.
+
+Parsing the 300 floats of every line of a `.vec` file takes minutes for the large files;
+instead, a file can be converted once with
+
+    $ python3 src/embedding_store.py /home/mizbicki/proj/korean/models/cc.ko.300.vec
+
+which writes the matrix `cc.ko.300.vec.emb` next to the `.vec` file
+(and the rank index of `rank_index.py`, which serves as its vocabulary).
+With `--dtype float16` the matrix takes half the space.
+The matrix is memory mapped read-only, so rows are only read from disk when they are used,
+and processes that open the same store share its pages through the page cache.
+Like the rank index, the store records the size and modification time of the `.vec` file,
+and a store whose `.vec` file has changed is considered stale and ignored.
+
+The store file contains the magic bytes, the header (5 uint64 values: the number of rows, the dimension,
+the size in bytes of a value, and the size and mtime_ns of the `.vec` file),
+and the matrix of the vectors of the lines of the `.vec` file after the header line, in row major order.
+'''
+
+import os
+import sys
+import logging
+from array import array
+
+import numpy as np
+
+sys.path.append('src')
+from binfile import MappedFile, write_array, has_magic
+from utils import vec_header
+import rank_index
+
+EMBEDDING_STORE_MAGIC = b'WKTEMB\x00\x01'
+
+dtypes = {
+    'float32': np.dtype('<f4'),
+    'float16': np.dtype('<f2'),
+    }
+
+
+def default_store_path(vec_path):
+    return vec_path + '.emb'
+
+
+def _source_stat(vec_path):
+    stat = os.stat(vec_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _parse_vectors(lines, dim):
+    '''
+    Return the vectors of the `.vec` lines `lines` (bytes without their newline) as a float32 matrix.
+    '''
+    rests = []
+    for line in lines:
+        parts = line.split(None, 1)
+        if not parts:
+            continue
+        if len(parts) < 2:
+            raise ValueError(f'line without a vector: {line[:100]!r}')
+        rests.append(parts[1])
+    if not rests:
+        return np.zeros((0, dim), dtype=np.float32)
+    vectors = np.loadtxt(rests, dtype=np.float32, ndmin=2)
+    if dim is not None and vectors.shape[1] != dim:
+        raise ValueError(f'expected vectors of dimension {dim}, found dimension {vectors.shape[1]}')
+    return vectors
+
+
+def build_store(vec_path, *, dtype='float32', store_path=None, block_size:int=2**24):
+    '''
+    Convert the vectors of a `.vec` file to a memory mapped matrix.
+
+    :vec_path: the fastText `.vec` file
+    :dtype: float32, or float16 to halve the size of the matrix
+    :store_path: where to write the matrix; defaults to the `.vec` path with `.emb` appended
+    :block_size: number of bytes of the `.vec` file to parse at a time
+    '''
+    store_path = store_path or default_store_path(vec_path)
+    value_dtype = dtypes[dtype]
+    source_size, source_mtime_ns = _source_stat(vec_path)
+    index = rank_index.open_index(vec_path)
+    if index is None:
+        rank_index.build_index(vec_path)
+    else:
+        index.close()
+
+    header = vec_header(vec_path)
+    dim = header[1] if header else None
+    num_rows = 0
+    logging.info(f'converting {vec_path}')
+    with open(vec_path, 'rb') as fin, open(store_path + '.tmp', 'wb') as fout:
+        if header:
+            fin.readline()
+        fout.write(EMBEDDING_STORE_MAGIC)
+        # the header is written again once the number of rows is known
+        write_array(fout, array('Q', [0] * 5))
+        tail = b''
+        while True:
+            block = fin.read(block_size)
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop() if block else b''
+            vectors = _parse_vectors(lines, dim)
+            if len(vectors):
+                dim = vectors.shape[1]
+                fout.write(vectors.astype(value_dtype).tobytes())
+                num_rows += len(vectors)
+                logging.debug(f'num_rows={num_rows}')
+            if not block:
+                break
+        fout.write(bytes(-fout.tell() % 8))
+        fout.seek(len(EMBEDDING_STORE_MAGIC))
+        write_array(fout, array('Q', [num_rows, dim or 0, value_dtype.itemsize, source_size, source_mtime_ns]))
+    os.replace(store_path + '.tmp', store_path)
+    logging.info(f'wrote {num_rows} vectors of dimension {dim} to {store_path}')
+
+
+class EmbeddingStore:
+    '''
+    The memory mapped vectors of a `.vec` file, indexed by word.
+
+    `vectors` is a read-only `np.memmap` with a row for every line of the `.vec` file after its header;
+    when a word appears on several lines, its vector is the one of the last line,
+    like its rank in `to_bli_dataset.load_rank_from_vec`.
+
+    >>> import tempfile
+    >>> vec_path = os.path.join(tempfile.mkdtemp(), 'example.vec')
+    >>> with open(vec_path, 'w') as fout:
+    ...     _ = fout.write('3 2\\nthe 0.5 1\\nof -2 0.25\\nthé 3 4\\n')
+    >>> build_store(vec_path, dtype='float16')
+    >>> store = open_store(vec_path)
+    >>> len(store), store.dim, store.vectors.dtype, store['of'].tolist(), store.get('cat')
+    (3, 2, dtype('float16'), [-2.0, 0.25], None)
+    >>> words, matrix = store.load(maxn=2)
+    >>> words, matrix.dtype, matrix.tolist()
+    (['the', 'of'], dtype('float32'), [[0.5, 1.0], [-2.0, 0.25]])
+    >>> store.close()
+    '''
+
+    def __init__(self, store_path, index):
+        with MappedFile(store_path, EMBEDDING_STORE_MAGIC) as f:
+            self.num_rows, self.dim, itemsize, self.source_size, self.source_mtime_ns = f.read_array('Q', 5)
+            offset = f.offset
+        value_dtype = dtypes['float16'] if itemsize == 2 else dtypes['float32']
+        self.vectors = np.memmap(store_path, dtype=value_dtype, mode='r', offset=offset, shape=(self.num_rows, self.dim))
+        self.index = index
+        self.first_row = 1 if index.has_header else 0
+
+    def row(self, word):
+        '''
+        Return the row of `word` in `vectors`, or None.
+        '''
+        rank = self.index.get(word)
+        if rank is None or rank < self.first_row:
+            return None
+        return rank - self.first_row
+
+    def get(self, word, default=None):
+        '''
+        Return the vector of `word` as a float32 array, or `default`.
+        '''
+        row = self.row(word)
+        return default if row is None else self.vectors[row].astype(np.float32)
+
+    def __getitem__(self, word):
+        vector = self.get(word)
+        if vector is None:
+            raise KeyError(word)
+        return vector
+
+    def __contains__(self, word):
+        return self.row(word) is not None
+
+    def __len__(self):
+        return self.num_rows
+
+    def load(self, maxn=None):
+        '''
+        Return the first `maxn` words of the `.vec` file and their vectors as a float32 matrix,
+        keeping only the first vector of a word that appears several times,
+        like `evaluate_bli.load_embeddings`.
+        '''
+        words = []
+        rows = []
+        seen = set()
+        for row, word in enumerate(self.index.words(self.num_rows)):
+            if maxn is not None and len(words) >= maxn:
+                break
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+                rows.append(row)
+        if rows and rows[-1] != len(rows) - 1:
+            return words, self.vectors[rows].astype(np.float32)
+        return words, np.array(self.vectors[:len(rows)], dtype=np.float32)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.index.close()
+        # the memory map is closed once no array refers to it
+        self.vectors = None
+
+
+def open_store(vec_path, store_path=None):
+    '''
+    Return the `EmbeddingStore` of `vec_path`,
+    or None if there is no store or the store is stale.
+    '''
+    store_path = store_path or default_store_path(vec_path)
+    if not os.path.exists(store_path):
+        return None
+    if not has_magic(store_path, EMBEDDING_STORE_MAGIC):
+        logging.warning(f'{store_path} has an unknown format; rebuild it with `python3 src/embedding_store.py {vec_path}`')
+        return None
+    with MappedFile(store_path, EMBEDDING_STORE_MAGIC) as f:
+        _, _, _, source_size, source_mtime_ns = f.read_array('Q', 5)
+    index = rank_index.open_index(vec_path)
+    if (source_size, source_mtime_ns) != _source_stat(vec_path) or index is None:
+        logging.warning(f'{store_path} is stale; rebuild it with `python3 src/embedding_store.py {vec_path}`')
+        if index is not None:
+            index.close()
+        return None
+    return EmbeddingStore(store_path, index)
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run(build_store)
@@ -0,0 +1,220 @@
+'''
+Evaluate aligned word embeddings on the bilingual lexicon induction (BLI) datasets in `final/`.
+
+    $ python3 src/evaluate_bli.py wiki.de.aligned.vec wiki.en.aligned.vec final/de-en.test
+
+prints precision@1/5/10 with nearest neighbor and CSLS retrieval
+for the test file and for each of its `.test.<POS>` files.
+A source word counts as correct at k if any of its English translations is among its k best candidates,
+and only the source words that have an embedding are evaluated (the coverage column).
+
+CSLS (Conneau et al., 2018) scores a source word x and an English word y with
+2cos(x, y) - r_en(x) - r_src(y), where r_en(x) is the mean similarity of x to its `csls_k` nearest English words
+and r_src(y) the mean similarity of y to its `csls_k` nearest source words.
+All similarities are computed with blocked matrix products of `block_size` rows and columns,
+so the memory does not grow with the product of the vocabulary sizes.
+'''
+
+import glob
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+import sys
+sys.path.append('src')
+import embedding_store
+
+
+def load_embeddings(vec_path, maxn=None):
+    '''
+    Return the words and the float32 vectors of the first `maxn` words of the fastText `.vec` file `vec_path`.
+    When a word appears several times, only its first vector is kept.
+    The matrix of `embedding_store.py` is used if it is up to date.
+    '''
+    store = embedding_store.open_store(vec_path)
+    if store is not None:
+        with store:
+            words, matrix = store.load(maxn)
+        logging.info(f'loaded {len(words)} vectors of dimension {matrix.shape[1]} from the store of {vec_path}')
+        return words, matrix
+    words = []
+    vectors = []
+    seen = set()
+    with open(vec_path, encoding='utf-8', errors='ignore') as fin:
+        for i, line in enumerate(fin):
+            parts = line.rstrip().split(' ', 1)
+            if i == 0 and len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+                continue
+            if len(parts) < 2 or parts[0] in seen:
+                continue
+            if maxn is not None and len(words) >= maxn:
+                break
+            seen.add(parts[0])
+            words.append(parts[0])
+            vectors.append(parts[1])
+    dim = len(vectors[0].split()) if vectors else 0
+    matrix = np.array(' '.join(vectors).split(), dtype=np.float32).reshape(len(words), dim)
+    logging.info(f'loaded {len(words)} vectors of dimension {dim} from {vec_path}')
+    return words, matrix
+
+
+def normalize(vectors):
+    '''
+    Return `vectors` scaled to unit length, so that dot products are cosine similarities.
+    '''
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-8)
+
+
+def topk(queries, keys, k, *, bias=None, block_size=4096):
+    '''
+    Return the scores and the indexes of the `k` keys with the largest score for every query,
+    in decreasing order of the score `queries @ keys.T - bias`.
+    The scores are computed for `block_size` queries and `block_size` keys at a time.
+
+    >>> keys = np.array([[1., 0.], [0., 1.], [.6, .8]])
+    >>> scores, indexes = topk(np.array([[1., 0.], [0., 1.]]), keys, 2, block_size=2)
+    >>> indexes.tolist(), scores.round(2).tolist()
+    ([[0, 2], [1, 2]], [[1.0, 0.6], [1.0, 0.8]])
+    '''
+    k = min(k, len(keys))
+    all_scores = np.empty((len(queries), k), dtype=np.result_type(queries, keys))
+    all_indexes = np.empty((len(queries), k), dtype=np.int64)
+    for i in range(0, len(queries), block_size):
+        q = queries[i:i+block_size]
+        scores = np.zeros((len(q), 0), dtype=all_scores.dtype)
+        indexes = np.zeros((len(q), 0), dtype=np.int64)
+        for j in range(0, len(keys), block_size):
+            sims = q @ keys[j:j+block_size].T
+            if bias is not None:
+                sims -= bias[j:j+block_size]
+            # keep the k best of the candidates so far and of this block
+            block_k = min(k, sims.shape[1])
+            best = np.argpartition(sims, -block_k, axis=1)[:, -block_k:]
+            scores = np.concatenate([scores, np.take_along_axis(sims, best, axis=1)], axis=1)
+            indexes = np.concatenate([indexes, best + j], axis=1)
+            if scores.shape[1] > k:
+                best = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, best, axis=1)
+                indexes = np.take_along_axis(indexes, best, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        all_scores[i:i+block_size] = np.take_along_axis(scores, order, axis=1)
+        all_indexes[i:i+block_size] = np.take_along_axis(indexes, order, axis=1)
+    return all_scores, all_indexes
+
+
+def load_dictionary(path):
+    '''
+    Return a dictionary from the source words of the dataset file `path` to their English translations.
+    '''
+    translations = defaultdict(lambda: set())
+    with open(path, encoding='utf-8') as fin:
+        for line in fin:
+            src, _, tgt = line.rstrip('\n').partition('\t')
+            translations[src].add(tgt)
+    return dict(translations)
+
+
+class Evaluator:
+    '''
+    Scores the BLI dictionaries of one language pair against aligned source and English embeddings.
+    The CSLS penalties of the English words are computed once, on the first use of CSLS.
+
+    >>> src_words, tgt_words = ['perro', 'gato', 'casa'], ['dog', 'cat', 'house']
+    >>> src = np.array([[1., .1], [.1, 1.], [.7, .7]], dtype=np.float32)
+    >>> tgt = np.array([[1., 0.], [0., 1.], [.6, .8]], dtype=np.float32)
+    >>> evaluator = Evaluator(src_words, src, tgt_words, tgt, csls_k=1)
+    >>> results = evaluator.evaluate({'perro': {'dog'}, 'gato': {'cat'}, 'casa': {'house'}, 'mesa': {'table'}})
+    >>> results['num_queries'], results['coverage'], results['nn'][1], results['nn'][5]
+    (3, 0.75, 1.0, 1.0)
+    '''
+
+    def __init__(self, src_words, src_vectors, tgt_words, tgt_vectors, *, ks=(1, 5, 10), csls_k=10, block_size=4096):
+        self.src_index = { word: i for i, word in enumerate(src_words) }
+        self.src = normalize(np.asarray(src_vectors, dtype=np.float32))
+        self.tgt_index = { word: i for i, word in enumerate(tgt_words) }
+        self.tgt = normalize(np.asarray(tgt_vectors, dtype=np.float32))
+        self.ks = ks
+        self.csls_k = csls_k
+        self.block_size = block_size
+        self._tgt_penalty = None
+
+    def tgt_penalty(self):
+        '''
+        Return r_src of every English word: its mean similarity to its `csls_k` nearest source words.
+        '''
+        if self._tgt_penalty is None:
+            scores, _ = topk(self.tgt, self.src, self.csls_k, block_size=self.block_size)
+            self._tgt_penalty = scores.mean(axis=1)
+        return self._tgt_penalty
+
+    def predict(self, queries, method='nn'):
+        '''
+        Return the indexes of the `max(ks)` best English words for the source vectors `queries`,
+        retrieved with `method` 'nn' (cosine similarity) or 'csls'.
+        '''
+        # r_en(x) is the same for all candidates of x, and so does not change their order
+        bias = self.tgt_penalty() / 2 if method == 'csls' else None
+        _, indexes = topk(queries, self.tgt, max(self.ks), bias=bias, block_size=self.block_size)
+        return indexes
+
+    def evaluate(self, translations, methods=('nn', 'csls')):
+        '''
+        Return the number of evaluated source words, the coverage,
+        and the precision@k of every method for the dictionary `translations` (see `load_dictionary`).
+        '''
+        srcs = [ src for src in translations if src in self.src_index ]
+        results = {
+            'num_queries': len(srcs),
+            'coverage': len(srcs) / max(len(translations), 1),
+            }
+        queries = self.src[[ self.src_index[src] for src in srcs ]]
+        for method in methods:
+            indexes = self.predict(queries, method)
+            hits = np.zeros(indexes.shape, dtype=bool)
+            for row, src in enumerate(srcs):
+                gold_indexes = { self.tgt_index[tgt] for tgt in translations[src] if tgt in self.tgt_index }
+                hits[row] = [ index in gold_indexes for index in indexes[row] ]
+            found = np.logical_or.accumulate(hits, axis=1)
+            results[method] = { k: float(found[:, min(k, found.shape[1])-1].mean()) if len(srcs) else 0. for k in self.ks }
+        return results
+
+
+def dataset_paths(test_path):
+    '''
+    Return the dataset file `test_path` and its per-POS files, keyed by their names.
+    '''
+    paths = {'all': test_path}
+    for path in sorted(glob.glob(glob.escape(test_path) + '.*')):
+        paths[path[len(test_path)+1:]] = path
+    return paths
+
+
+def evaluate(src_vec, tgt_vec, test_path, *, maxn:int=200000, csls_k:int=10, block_size:int=4096):
+    '''
+    Print the BLI precision of aligned embeddings on a dataset file and its per-POS files.
+
+    :src_vec: the `.vec` file of the aligned source language embeddings
+    :tgt_vec: the `.vec` file of the aligned English embeddings
+    :test_path: a dataset file such as `final/de-en.test`
+    :maxn: number of words of each `.vec` file to load
+    :csls_k: number of neighbors of the CSLS penalties
+    :block_size: number of rows and columns of the blocked similarity matrices
+    '''
+    src_words, src_vectors = load_embeddings(src_vec, maxn)
+    tgt_words, tgt_vectors = load_embeddings(tgt_vec, maxn)
+    evaluator = Evaluator(src_words, src_vectors, tgt_words, tgt_vectors, csls_k=csls_k, block_size=block_size)
+    methods = ('nn', 'csls')
+    header = f'{"dataset":16} {"queries":>8} {"coverage":>8} ' + ' '.join(f'{method}@{k:<4}' for method in methods for k in evaluator.ks)
+    print(header)
+    for name, path in dataset_paths(test_path).items():
+        results = evaluator.evaluate(load_dictionary(path), methods)
+        precisions = ' '.join(f'{results[method][k]:>{len(method)+5}.4f}' for method in methods for k in evaluator.ks)
+        print(f'{name:16} {results["num_queries"]:8} {results["coverage"]:8.4f} {precisions}')
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run(evaluate)
@@ -5,13 +5,19 @@ Parse a raw wiktionary dump into a machine readable intermediate format.
 import re
 import json
 import os
+import shutil
 import logging
-from collections import defaultdict, Counter
+import functools
+import hashlib
+import multiprocessing
+from collections import defaultdict, Counter, namedtuple
+from xml.etree import ElementTree
 from wiki_dump_reader import Cleaner, iterate
 
 import sys
 sys.path.append('src')
-from utils import escape
+from utils import escape, LRUCache
+from intermediate import IntermediateWriter, check_appendable
 
 
 def extract_header(line):
@@ -75,7 +81,7 @@ def clean_brackets(text):
     return ''.join(ret)
 
 
-def parse_line(text, check_hash=True):
+def parse_line(text, check_hash=True, fast_path=True, stats=None):
     """
     A template is wiktionary code inside the double curly braces {{ }}.
     Most templates do not include text that is part of a definition, and so we simply drop the template:
@@ -177,18 +183,61 @@ def parse_line(text, check_hash=True):
 
     """
 
+    ret = defaultdict(lambda: [])
+    chunks = plain_chunks(text) if fast_path and type(text) is str else None
+    if chunks is None:
+        chunks = wikicode_chunks(text, ret, stats)
+
+    if not check_hash or (len(text) > 1 and (text[1] == ' ' or text[1].isalpha())):
+        ret['text'] = ''.join(chunks).strip()
+    else:
+        ret['text'] = ''
+    ret['translations'] = extract_definitions(ret['text'])
+    return ret
+
+
+def wikicode_chunks(text, ret, stats=None):
+    '''
+    Parse `text` with mwparserfromhell and return the chunks of definition text for `parse_line`;
+    the information found in templates is stored in `ret`, and the templates are counted in `stats`.
+
+    The templates nested in template arguments and links are counted whether or not their parse is cached:
+
+    >>> counts = []
+    >>> for _ in range(2):
+    ...     stats = ExtractStats()
+    ...     _ = parse_line('# {{vern|African {{w|Golden cat|golden}} cat}}', stats=stats)
+    ...     counts.append(stats.template_names)
+    >>> counts[0] == counts[1], sorted(counts[0].items())
+    (True, [('vern', 1), ('w', 1)])
+    '''
     import mwparserfromhell
     wikicode = mwparserfromhell.parse(text)
-    ret = defaultdict(lambda: [])
-    
+
     def recurse(v):
         if v:
-            try:
-                r = parse_line(v.value, check_hash=False)
-            except AttributeError:
-                r = parse_line(v, check_hash=False)
-            chunks.append(r['text'])
-            ret['unknown_templates'].extend(r['unknown_templates'])
+            # template arguments and link targets repeat constantly across the dump,
+            # so their parses are cached by their raw text
+            value = getattr(v, 'value', v)
+            key = str(value)
+            cached = recurse_cache.get(key)
+            if cached is None:
+                # the nested templates are cached with the text, so that they are counted on every hit
+                nested_stats = ExtractStats()
+                r = parse_line(value, check_hash=False, stats=nested_stats)
+                cached = recurse_cache[key] = (
+                    r['text'],
+                    tuple(r.get('unknown_templates', ())),
+                    tuple(nested_stats.template_names.elements()),
+                    tuple(nested_stats.unknown_template_names.elements()),
+                    )
+            text, unknown_templates, template_names, unknown_template_names = cached
+            chunks.append(text)
+            if unknown_templates:
+                ret['unknown_templates'].extend(unknown_templates)
+            if stats is not None:
+                stats.template_names.update(template_names)
+                stats.unknown_template_names.update(unknown_template_names)
 
     chunks = []
     for node in wikicode.nodes:
@@ -204,172 +253,362 @@ def parse_line(text, check_hash=True):
         elif type(node) is mwparserfromhell.nodes.tag.Tag:
             pass
 
-        # {{templates}} require complex processing for each different template
+        # {{templates}} require complex processing for each different template;
+        # see `classify_template` for how the processing is selected
         elif type(node) is mwparserfromhell.nodes.template.Template:
             nodename = str(node.name).strip().lower()
-            template_names[nodename] += 1
-            if nodename in ['place']:
-                # FIXME: this is really complicated to parse
-                recurse(node.get('gloss', node.get('t1', node.get('t2', node.get('t', node.get(2, None))))))
-            elif nodename in ['place']:
-                recurse(node.get('gloss', node.get('t', node.get(2, None))))
-            elif nodename in ['initialism of']:
-                recurse(node.get('gloss', node.get('t', node.get(2, None))))
-            elif nodename in ['w', 'unsupported']:
-                recurse(node.get(2, node.get(1, None)))
-            elif nodename in ['m', 'mention', 'l', 'link', 'l-lite', 'm-lite']:
-                recurse(node.get('gloss', node.get('t', node.get(4, node.get(3, node.get(2, node.get(1, None)))))))
-            elif nodename in ['zh-l']:
-                recurse(node.get('gloss', node.get('t', None)))
-            elif nodename in ['zh-classifier', 'th-l', 'zh-original', 'zh-abbrev']:
-                recurse(node.get('gloss', node.get(2, node.get('t', None))))
-
-            # capture non-gloss definitions ('non-gloss', 'non-gloss definition', non gloss', etc.)
-            elif 'non' in nodename and 'gloss' in nodename:
-                recurse(node.get(1, None))
-
-            # just ignore these templates
-            elif nodename.endswith('usex') or nodename in [ 
-                # definition needed
-                'rfdef',
-                'rfclarify',
-                'rfex',
-                'attention',
-
-                # used on individual letters
-                'Latn-def', 'Latn-def-lite', 'Latn-def',
-                'latn-def', 'latn-def-lite', 'latn-def',
-
-                # add non-definitional extra information
-                'gl', 'gloss', 'gloss-lite',
-                'lb', 'lbl', 'label', 'tlb', 'term-label',
-                'ng', 'n-g', 'ngd', 'n-g-lite',
-                'q', 'qf', 'qual', 'qualifier', 'q-lite', 'qualifier-lite', 'i',
-                'c', 'C', 'topics', 'top',
-                'given name', 'surname',
-                'defdate',
-                '+obj',
-                'cln',
-                'only used in', 'used in phrasal verbs',
-                'term-label',
-                'ja-def', 'ja-x', 'ko-x',
-                'mul-kangxi radical-def',
-                'zh-mw', 'zh-div',
-                'short for',
-
-                # possibly these could be added?
-                'bond credit rating',
-                'taxon',
-
-                # a type of anchor tag
-                'anchor', 'senseid', 'rfd-sense', 'rfv-sense', 'sense', 'sense-lite',
-
-                # typography
-                ',', 'isbn', '...', 'nbsp', 'mono', 'monospace',
-
-                # quotes
-                'ux', 'uxi', 'zh-x', 'ja-usex', 'ko-usex', 'suffixusex', 'usex', 'th-x', 'th-usex', 'hi-x',
-                'quote', 'quote-book', 'quote-journal', 'Q', 'quote-text', 'quote-web', 'quote-newsgroup',
-
-                # ?
-                'coi', '†', 'zh-obsolete',
-                ] or 'quote' in nodename or 'rq:' in nodename :
-                pass
-
-            # specialized templates
-            elif nodename in ['iso 639', 'iso 3166']:
-                recurse(node.get(3, None))
-            elif nodename in ['vern']:
-                recurse(node.get(1, None))
-            elif nodename in ['taxlink']:
-                recurse(node.get(3, node.get(1, None)))
-            elif nodename in ['frac']:
-                recurse(node.get(1, None))
-                chunks.append('/')
-                recurse(node.get(2, None))
-            elif nodename in ['lang']:
-                recurse(node.get(2, None))
-            elif nodename in ['name translit']:
-                recurse(node.get(3, None))
-
-            # inflections
-            elif  nodename in ['hanja form of', 'ko-hanja form of']:
-                recurse(node.get('gloss', node.get(2, node.get('t', None))))
-            elif nodename in ['ca-verb form of', 'nl-verb form of']:
-                pass # these templates never store English glosses
-            elif nodename in [
-                'alt of', 'altform', 'alt form', 'alternative form of',
-                'nonstandard form of', 'standard form of',
-                'synonym of', 'syn of',
-                'abbreviation of', 'clipping of',
-                'female equivalent of', 'femeq',
-                'cognate', 'cog',
-                ]:
-                gloss = node.get(4, node.get('t', node.get('gloss', None)))
-                if gloss:
-                    recurse(gloss)
-                else:
-                    ret['conjugations'].append(str(node))
-            elif nodename in ['form of']:
-                gloss = node.get(5, node.get('t', node.get('gloss', None)))
-                if gloss:
-                    recurse(gloss)
-                else:
-                    ret['conjugations'].append(str(node))
-            elif ((len(nodename)>5 and nodename[2] == '-') or 
-                  nodename.endswith(' of') or
-                  nodename.endswith('-of') or
-                  nodename.endswith('-alt') or
-                  nodename.endswith(' sp') or
-                  nodename.startswith('alt') or
-                  '-form-' in nodename or
-                  nodename in [
-                    'clipping',
-                    'missp',
-                    'fr-post-1990',
-                    ]):
-                gloss = node.get('t', node.get('gloss', None))
-                if gloss:
-                    recurse(gloss)
-                else:
-                    ret['conjugations'].append(str(node))
-
-            # templates that we might need to expand later
-            elif '-conj' in nodename:
-                ret['conjexp'].append(str(node))
-
-            # reverse translations
-            elif nodename in ['t', 't+', 'tt', 'tt+', 't-check', 't-simple']:
-                ret['reverse_translations'].append(str(node))
-
-            # synonyms; see https://en.wiktionary.org/wiki/Category:Semantic_relation_templates
-            elif nodename in ['syn', 'synonyms', 'cot', 'coordinate terms', 'ant', 'antonym', 'antonyms', 'holonyms', 'hypernyms', 'hypo', 'hyponyms', 'holonyms', 'holo', 'hyper', 'impf', 'imperfectives', 'meronyms', 'inline alt forms', 'perfectives', 'pf', 'troponyms']:
-                for i in range(2,100):
-                    v = node.get(i, None)
-                    if v:
-                        v = rm_parens(str(v), '<>')
-                        if ':' not in v and ';' not in v:
-                            ret[nodename[:3]].append(v)
-                    t = node.get('t'+str(i), None)
-                    if not v and not t:
-                        break
-
-
-            # couldn't match the template
-            else:
-                ret['unknown_templates'].append(str(node))
-                unknown_template_names[nodename] += 1
+            handler = classify_template(nodename)
+            handler(node, nodename, recurse, chunks, ret)
+            if stats is not None:
+                stats.template_names[nodename] += 1
+                if handler is unknown_template:
+                    stats.unknown_template_names[nodename] += 1
 
         # if it's not a template or a link, just return the raw text
         else:
             chunks.append(str(node))
+    return chunks
 
-    if not check_hash or (len(text) > 1 and (text[1] == ' ' or text[1].isalpha())):
-        ret['text'] = ''.join(chunks).strip()
-    else:
-        ret['text'] = ''
-    ret['translations'] = extract_definitions(ret['text'])
-    return ret
+
+# markup that `plain_chunks` leaves to mwparserfromhell
+_plain_fallback_re = re.compile(r"[{}<>&\n\x00]")
+_plain_wikilink_re = re.compile(r"\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]")
+_plain_quotes_re = re.compile(r"'{2,}")
+# link titles that mwparserfromhell may parse as external links without slashes, e.g. [[mailto:x]]
+_plain_scheme_re = re.compile(r"\s*([A-Za-z][A-Za-z0-9+.-]*):")
+
+
+def plain_chunks(text):
+    """
+    Return the chunks of definition text for `parse_line` without calling mwparserfromhell,
+    or None if `text` contains markup that this fast path does not handle.
+
+    Most definition lines contain only list markup, [[wikilinks]] and bold/italic quotes,
+    and these are cheap to process directly.
+    Lines with templates, html, entities, or ambiguous brackets and quotes fall back to mwparserfromhell.
+
+    >>> plain_chunks("# [[dog]], [[hound]]")
+    [' ', 'dog', ', ', 'hound']
+    >>> plain_chunks("# (''intransitive'') to [[run|running]]")
+    [' (', ') to ', 'running']
+    >>> plain_chunks("# {{lb|ms|Indonesia}} [[free]]") is None
+    True
+
+    Both paths give identical results:
+
+    >>> lines = [
+    ...     "# [[dog]], [[hound]]",
+    ...     "# [[free]], [[gratis]]",
+    ...     "# to [[realize]] (come to comprehend)",
+    ...     "# [[#English|free]] of [[charge]]",
+    ...     "# (''intransitive'') to [[run]], to [[jog]]",
+    ...     "# a [[piece]]/[[scrap]]/[[slice]] (of an object); [[shard]], [[sliver]]",
+    ...     "# '''bold''' thing, [[stuff|stuffs]]",
+    ...     "# [[w:Manuel Ignacio de Vivanco|Manuel Ignacio de Vivanco]]; [[Vivanco]]'s",
+    ...     "# [[File:Dog.jpg|thumb|A dog]]",
+    ...     "# [[a|]] [[ b | c ]]",
+    ...     "# [[mailto:x]]",
+    ...     "# [[news:foo]]",
+    ...     "# [[tel:123]]",
+    ...     "# [[Mailto:x|label]], [[ geo:1 ]]",
+    ...     "#: an [[example]] [[sentence]]",
+    ...     "#* ''1605'', Miguel de Cervantes, ''Don Quijote''",
+    ...     "#*:: [...]; and ''Los cuentos de Borges'' [The stories of the Borges]",
+    ...     "# don''t ''x''",
+    ...     "# ''''four'''' quotes",
+    ...     "#; term : definition",
+    ...     "# [[a[b]]",
+    ...     "# see http://example.com",
+    ...     "# plain text, no markup",
+    ...     "#",
+    ...     "",
+    ... ]
+    >>> [ line for line in lines if parse_line(line) != parse_line(line, fast_path=False) ]
+    []
+    >>> sum(plain_chunks(line) is not None for line in lines)
+    16
+    """
+    if _plain_fallback_re.search(text) or text.startswith(('=', '----')):
+        return None
+
+    # list markup at the start of the line is dropped
+    start = 0
+    while start < len(text) and text[start] in '#*:;':
+        if text[start] == ';':
+            return None
+        start += 1
+
+    # split the line into text, [[link]] and quote tokens
+    tokens = []
+    for i, segment in enumerate(_plain_wikilink_re.split(text[start:])):
+        if i%3 == 0:
+            if '[' in segment or ']' in segment:
+                return None
+            pos = 0
+            for match in _plain_quotes_re.finditer(segment):
+                tokens.append(segment[pos:match.start()])
+                tokens.append(len(match.group()))
+                pos = match.end()
+            tokens.append(segment[pos:])
+        elif i%3 == 1:
+            title = segment
+        else:
+            linktext = segment
+            if not title.strip() or '//' in title or "''" in title or (linktext and "''" in linktext):
+                return None
+            scheme = _plain_scheme_re.match(title)
+            if scheme:
+                from mwparserfromhell.definitions import is_scheme
+                if is_scheme(scheme.group(1), slashes=False):
+                    return None
+            # the displayed text of the link, as `parse_line` computes it from the link's nodes
+            tokens.append([(linktext or title).strip()])
+
+    # drop the text between matching quotes, like mwparserfromhell's Tag nodes
+    chunks = []
+    open_quote = None
+    for token in tokens:
+        if type(token) is int:
+            if token not in [2, 3]:
+                return None
+            if open_quote is None:
+                open_quote = token
+            elif open_quote == token:
+                open_quote = None
+            else:
+                return None
+        elif open_quote is None:
+            if type(token) is list:
+                chunks.extend(token)
+            elif token:
+                chunks.append(token)
+    if open_quote is not None:
+        return None
+    return chunks
+
+
+################################################################################
+# template handlers
+################################################################################
+
+# `parse_line` looks up the handler for each template by its lowercased name.
+# A handler is called as `handler(node, nodename, recurse, chunks, ret)`, where
+# `node` is the mwparserfromhell template, `nodename` its lowercased name,
+# `recurse(arg)` inlines the text of a template argument into the definition,
+# `chunks` is the list of text chunks of the definition,
+# and `ret` is the dictionary that `parse_line` returns.
+template_handlers = {}
+
+
+def register_template(handler, *names):
+    '''
+    Make `parse_line` process the templates `names` with `handler`.
+
+    Registered names take precedence over the prefix/suffix rules in `classify_template`.
+    '''
+    for name in names:
+        template_handlers[name.lower()] = handler
+    classify_template.cache_clear()
+
+
+@functools.lru_cache(maxsize=2**16)
+def classify_template(nodename):
+    '''
+    Return the handler for the lowercased template name `nodename`.
+
+    Names registered with `register_template` are found with a single dictionary lookup;
+    other names are classified by prefix/suffix rules.
+    The result is memoized, so the rules are only evaluated once per distinct template name.
+
+    >>> classify_template('l').__name__
+    'inline_gloss'
+    >>> classify_template('quote-book').__name__
+    'ignore_template'
+    >>> classify_template('es-verb form of').__name__
+    'inflection_of'
+    >>> classify_template('not a template').__name__
+    'unknown_template'
+    '''
+    handler = template_handlers.get(nodename)
+    if handler:
+        return handler
+
+    # capture non-gloss definitions ('non-gloss', 'non-gloss definition', non gloss', etc.)
+    if 'non' in nodename and 'gloss' in nodename:
+        return inline_arg(1)
+
+    # usage examples and quotations
+    if nodename.endswith('usex') or 'quote' in nodename or 'rq:' in nodename:
+        return ignore_template
+
+    # inflections
+    if ((len(nodename)>5 and nodename[2] == '-') or
+        nodename.endswith(' of') or
+        nodename.endswith('-of') or
+        nodename.endswith('-alt') or
+        nodename.endswith(' sp') or
+        nodename.startswith('alt') or
+        '-form-' in nodename):
+        return inflection_of
+
+    # templates that we might need to expand later
+    if '-conj' in nodename:
+        return conjugation_table
+
+    return unknown_template
+
+
+def first_arg(node, *keys):
+    '''
+    Return the first of the arguments `keys` that the template `node` has, or None.
+    '''
+    for key in keys:
+        arg = node.get(key, None)
+        if arg is not None:
+            return arg
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def inline_arg(*keys):
+    '''
+    Return a handler that inlines the first of the arguments `keys` that the template has.
+    '''
+    def inline_gloss(node, nodename, recurse, chunks, ret):
+        recurse(first_arg(node, *keys))
+    return inline_gloss
+
+
+def ignore_template(node, nodename, recurse, chunks, ret):
+    pass
+
+
+def unknown_template(node, nodename, recurse, chunks, ret):
+    ret['unknown_templates'].append(str(node))
+
+
+def frac(node, nodename, recurse, chunks, ret):
+    recurse(node.get(1, None))
+    chunks.append('/')
+    recurse(node.get(2, None))
+
+
+def inflection_of_gloss(*keys):
+    '''
+    Return a handler for templates like {{form of}} that either have an English gloss in one of the arguments `keys`,
+    or otherwise mark the word as an inflection of another word.
+    '''
+    def inflection_of(node, nodename, recurse, chunks, ret):
+        gloss = first_arg(node, *keys)
+        if gloss:
+            recurse(gloss)
+        else:
+            ret['conjugations'].append(str(node))
+    return inflection_of
+
+
+inflection_of = inflection_of_gloss('t', 'gloss')
+
+
+def conjugation_table(node, nodename, recurse, chunks, ret):
+    ret['conjexp'].append(str(node))
+
+
+def reverse_translation(node, nodename, recurse, chunks, ret):
+    ret['reverse_translations'].append(str(node))
+
+
+def semantic_relation(node, nodename, recurse, chunks, ret):
+    for i in range(2,100):
+        v = node.get(i, None)
+        if v:
+            v = rm_parens(str(v), '<>')
+            if ':' not in v and ';' not in v:
+                ret[nodename[:3]].append(v)
+        t = node.get('t'+str(i), None)
+        if not v and not t:
+            break
+
+
+# FIXME: this is really complicated to parse
+register_template(inline_arg('gloss', 't1', 't2', 't', 2), 'place')
+register_template(inline_arg('gloss', 't', 2), 'initialism of')
+register_template(inline_arg(2, 1), 'w', 'unsupported')
+register_template(inline_arg('gloss', 't', 4, 3, 2, 1), 'm', 'mention', 'l', 'link', 'l-lite', 'm-lite')
+register_template(inline_arg('gloss', 't'), 'zh-l')
+register_template(inline_arg('gloss', 2, 't'), 'zh-classifier', 'th-l', 'zh-original', 'zh-abbrev')
+
+# just ignore these templates
+register_template(ignore_template,
+    # definition needed
+    'rfdef',
+    'rfclarify',
+    'rfex',
+    'attention',
+
+    # used on individual letters
+    'latn-def', 'latn-def-lite',
+
+    # add non-definitional extra information
+    'gl', 'gloss', 'gloss-lite',
+    'lb', 'lbl', 'label', 'tlb', 'term-label',
+    'ng', 'n-g', 'ngd', 'n-g-lite',
+    'q', 'qf', 'qual', 'qualifier', 'q-lite', 'qualifier-lite', 'i',
+    'c', 'topics', 'top',
+    'given name', 'surname',
+    'defdate',
+    '+obj',
+    'cln',
+    'only used in', 'used in phrasal verbs',
+    'ja-def', 'ja-x', 'ko-x',
+    'mul-kangxi radical-def',
+    'zh-mw', 'zh-div',
+    'short for',
+
+    # possibly these could be added?
+    'bond credit rating',
+    'taxon',
+
+    # a type of anchor tag
+    'anchor', 'senseid', 'rfd-sense', 'rfv-sense', 'sense', 'sense-lite',
+
+    # typography
+    ',', 'isbn', '...', 'nbsp', 'mono', 'monospace',
+
+    # quotes
+    'ux', 'uxi', 'zh-x', 'th-x', 'hi-x',
+
+    # ?
+    'coi', '†', 'zh-obsolete',
+    )
+
+# specialized templates
+register_template(inline_arg(3), 'iso 639', 'iso 3166')
+register_template(inline_arg(1), 'vern')
+register_template(inline_arg(3, 1), 'taxlink')
+register_template(frac, 'frac')
+register_template(inline_arg(2), 'lang')
+register_template(inline_arg(3), 'name translit')
+
+# inflections
+register_template(inline_arg('gloss', 2, 't'), 'hanja form of', 'ko-hanja form of')
+register_template(ignore_template, 'ca-verb form of', 'nl-verb form of') # these templates never store English glosses
+register_template(inflection_of_gloss(4, 't', 'gloss'),
+    'alt of', 'altform', 'alt form', 'alternative form of',
+    'nonstandard form of', 'standard form of',
+    'synonym of', 'syn of',
+    'abbreviation of', 'clipping of',
+    'female equivalent of', 'femeq',
+    'cognate', 'cog',
+    )
+register_template(inflection_of_gloss(5, 't', 'gloss'), 'form of')
+register_template(inflection_of, 'clipping', 'missp', 'fr-post-1990')
+
+# reverse translations
+register_template(reverse_translation, 't', 't+', 'tt', 'tt+', 't-check', 't-simple')
+
+# synonyms; see https://en.wiktionary.org/wiki/Category:Semantic_relation_templates
+register_template(semantic_relation, 'syn', 'synonyms', 'cot', 'coordinate terms', 'ant', 'antonym', 'antonyms', 'holonyms', 'hypernyms', 'hypo', 'hyponyms', 'holo', 'hyper', 'impf', 'imperfectives', 'meronyms', 'inline alt forms', 'perfectives', 'pf', 'troponyms')
 
 
 def rm_parens(text, brackets="()"):
@@ -522,7 +761,21 @@ def find_entry(word, dump='data/enwiktionary-20220701-pages-articles-multistream
             return text
 
 
-def process_entry(title, text, allow_spaces=True):
+@functools.lru_cache(maxsize=None)
+def language_headers_re(languages):
+    r'''
+    Return a regex that matches the level 2 headers `==Language==` of the frozenset `languages`.
+
+    >>> bool(language_headers_re(frozenset(['German'])).search('==English==\n==German==\n===Noun==='))
+    True
+    >>> bool(language_headers_re(frozenset(['German'])).search('==English==\n===German==='))
+    False
+    '''
+    names = '|'.join(re.escape(language) for language in sorted(languages))
+    return re.compile(r'^==[^\S\n]*(?:' + names + r')[^\S\n]*==$', re.MULTILINE)
+
+
+def process_entry(title, text, allow_spaces=True, languages=None, stats=None):
     r'''
 
     FIXME:
@@ -547,6 +800,13 @@ def process_entry(title, text, allow_spaces=True):
 
     if ' ' in title and not allow_spaces:
         return title, {}
+
+    # when only some languages are wanted,
+    # pages without any of their sections are skipped before any line-level parsing
+    if languages is not None and not language_headers_re(languages).search(text):
+        return title, {}
+    wanted = lambda language: languages is None or language in languages
+
     title = title.strip()
     lines = group_squiggles(text).split('\n')
 
@@ -560,11 +820,11 @@ def process_entry(title, text, allow_spaces=True):
     for line in lines:
         (level, header) = extract_header(line)
         if level == 2:
-            if current_language:
+            if current_language and wanted(current_language) and stats is not None:
                 if not lang_hasword and lang_hashash:
-                    bad_langwords.append((title, current_language))
+                    stats.bad_langwords += 1
                 else:
-                    good_langwords.append((title, current_language))
+                    stats.good_langwords += 1
             current_language = header.strip()
             lang_hasword = False
             lang_hashash = False
@@ -577,11 +837,14 @@ def process_entry(title, text, allow_spaces=True):
                 if current_subheader in ['Definitions', 'Kanji', 'Hanji', 'Hanja']:
                     current_subheader = 'Noun'
 
+        if not wanted(current_language):
+            continue
+
         # FIXME:
         # we should probably parse everything, but that's slow
         if line.startswith('#'):
             lang_hashash = True
-            parse = parse_line(line)
+            parse = parse_line(line, stats=stats)
             for k,v in parse.items():
                 if k != 'text':
                     if k != 'unknown_templates':
@@ -596,69 +859,508 @@ def process_entry(title, text, allow_spaces=True):
                             #else:
                             parse_info[current_language][current_subheader]['translations'][translation] += 1
 
-    if not page_hasword and page_hashash:
-        bad_pages.append(title)
-    else:
-        good_pages.append(title)
+    if stats is not None:
+        if not page_hasword and page_hashash:
+            stats.bad_pages += 1
+        else:
+            stats.good_pages += 1
 
     return [title, parse_info]
 
 
-# FIXME:
-# these are hacks to record some parsing statistics;
-bad_pages = []
-bad_langwords = []
-good_pages = []
-good_langwords = []
+class ExtractStats:
+    '''
+    Parsing statistics of `extract_intermediate`.
+
+    Only the counts that get reported are kept, so memory use does not grow with the size of the dump.
+    The statistics of separate worker processes can be combined with `merge`,
+    and they can be saved as json to compare runs.
+
+    >>> stats = ExtractStats()
+    >>> stats.template_names['l'] += 2
+    >>> other = ExtractStats()
+    >>> other.template_names['l'] += 1
+    >>> other.good_pages += 1
+    >>> stats.merge(other).template_names
+    Counter({'l': 3})
+    >>> ExtractStats.from_json(stats.to_json()).to_json() == stats.to_json()
+    True
+    '''
+
+    def __init__(self):
+        self.good_pages = 0
+        self.bad_pages = 0
+        self.good_langwords = 0
+        self.bad_langwords = 0
+        self.recurse_cache_hits = 0
+        self.recurse_cache_misses = 0
+        self.template_names = Counter()
+        self.unknown_template_names = Counter()
+
+    def merge(self, other):
+        '''
+        Add the counts of `other` to `self`, and return `self`.
+        '''
+        for name, value in vars(other).items():
+            if isinstance(value, Counter):
+                getattr(self, name).update(value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def to_json(self):
+        return json.dumps(vars(self), ensure_ascii=False, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        for name, value in json.loads(data).items():
+            if isinstance(getattr(stats, name), Counter):
+                value = Counter(value)
+            setattr(stats, name, value)
+        return stats
+
+    def report(self):
+        print('Found Templates:')
+        for k,v in self.template_names.most_common(20):
+            print(f'  {k:30} - {v:8}')
+
+        print('Unkown Templates:')
+        for k,v in self.unknown_template_names.most_common(200):
+            print(f'  {k:30} - {v:8}')
+
+        print("bad_pages=",self.bad_pages)
+        print("bad_langwords=",self.bad_langwords)
+        print("good_pages=",self.good_pages)
+        print("good_langwords=",self.good_langwords)
+        print("recurse_cache_hits=",self.recurse_cache_hits)
+        print("recurse_cache_misses=",self.recurse_cache_misses)
+
+
+# parses of the template arguments and links inside definitions, with the names of the templates nested in them
+recurse_cache = LRUCache(2**18)
+
+
+# `end` is the byte offset in the dump just after the page;
+# iterating from this offset continues with the next page
+Page = namedtuple('Page', ['title', 'text', 'revision', 'end'])
+
+
+def iterate_pages(dumpfile, start=0, end=None):
+    '''
+    Yield a `Page` for every article whose `<page>` line begins in the byte range [start, end) of `dumpfile`.
+
+    This follows `wiki_dump_reader.iterate` line for line,
+    but because it works on byte ranges the dump can be split between several processes.
+    Iterating over all of the ranges from `chunk_offsets` visits exactly the pages that `iterate` does, in the same order.
+    '''
+    with open(dumpfile, 'rb') as fin:
+        if start > 0:
+            # skip the partial line; it belongs to the previous chunk
+            fin.seek(start-1)
+            fin.readline()
+        content = None
+        while True:
+            if end is not None and content is None and fin.tell() >= end:
+                break
+            rawline = fin.readline()
+            if not rawline:
+                break
+            # codecs.open (used by `iterate`) also splits lines on unicode line breaks
+            for line in rawline.decode('utf-8').splitlines():
+                line = line.strip()
+                if line == '<page>':
+                    content = [line]
+                elif line == '</page>':
+                    if content is None:
+                        continue
+                    content.append(line)
+                    page = _parse_page('\n'.join(content), fin.tell())
+                    content = None
+                    if page:
+                        yield page
+                elif content is not None:
+                    content.append(line)
+
+
+def _parse_page(content, end):
+    '''
+    Return the `Page` of a `<page>...</page>` xml string, or None if the page is not an article.
+    '''
+    tree = ElementTree.fromstring(content)
+    ns_elem = tree.find('ns')
+    if ns_elem is None or ns_elem.text.strip() != '0':
+        return None
+    title_elem = tree.find('title')
+    if title_elem is None:
+        return None
+    text_elem = tree.find('revision/text')
+    if text_elem is None or text_elem.text is None:
+        return None
+    revision_elem = tree.find('revision/id')
+    revision = revision_elem.text if revision_elem is not None else None
+    return Page(title_elem.text, text_elem.text, revision, end)
+
+
+def chunk_offsets(dumpfile, num_chunks):
+    '''
+    Split `dumpfile` into `num_chunks` byte ranges of (nearly) equal size.
+    '''
+    size = os.path.getsize(dumpfile)
+    return [ (size*k//num_chunks, size*(k+1)//num_chunks) for k in range(num_chunks) ]
+
+
+def write_parseinfo(title, parseinfo, writer):
+    '''
+    Append the records that `process_entry` found for `title` to an `IntermediateWriter`,
+    and return the paths (relative to the intermediate directory) of the files that were written to.
+    '''
+    paths = []
+    for lang in parseinfo.keys():
+        for pos in parseinfo[lang].keys():
+            if pos and lang:
+                for parsekey,parseval in parseinfo[lang][pos].items():
+                    if parseval:
+                        json_dump = json.dumps({'srcs': [title], 'tgts': list(parseval.keys())}, ensure_ascii = False)
+                        writer.write(lang, parsekey+'.'+pos, json_dump + '\n')
+                        paths.append(os.path.join(lang, parsekey+'.'+pos))
+    return paths
+
+
+def _extract_chunk(job):
+    '''
+    Worker for `extract_intermediate(workers>1)`;
+    parses the pages of one byte range of the dump into the shard directory `shard_dir`.
+
+    The `ExtractStats` of this chunk are returned so that the parent process can combine them.
+    '''
+    dumpfile, start, end, shard_dir, allow_spaces, languages = job
+    stats = ExtractStats()
+    recurse_cache.hits = recurse_cache.misses = 0
+    with IntermediateWriter(shard_dir) as writer:
+        for i, (title, text, _, _) in enumerate(iterate_pages(dumpfile, start, end)):
+            _, parseinfo = process_entry(title, text, allow_spaces=allow_spaces, languages=languages, stats=stats)
+            write_parseinfo(title, parseinfo, writer)
+            if i%1000 == 0:
+                logging.info(f'start={start}, i={i}, title={title}')
+    stats.recurse_cache_hits = recurse_cache.hits
+    stats.recurse_cache_misses = recurse_cache.misses
+    return stats
+
+
+def merge_shards(shard_dirs, intermediate_dir):
+    '''
+    Append the files of each shard to `intermediate_dir`.
 
-template_names = Counter()
-unknown_template_names = Counter()
-found_glosses = Counter()
+    The shards must be listed in dump order;
+    each output file then contains exactly the lines (and line order) that a serial run would have written.
+    '''
+    for shard_dir in shard_dirs:
+        if not os.path.isdir(shard_dir):
+            continue
+        for lang in sorted(os.listdir(shard_dir)):
+            dirpath = os.path.join(intermediate_dir, lang)
+            os.makedirs(dirpath, exist_ok=True)
+            for filename in sorted(os.listdir(os.path.join(shard_dir, lang))):
+                check_appendable(os.path.join(dirpath, filename))
+                with open(os.path.join(shard_dir, lang, filename), 'rb') as fin:
+                    with open(os.path.join(dirpath, filename), 'ab') as fout:
+                        shutil.copyfileobj(fin, fout)
+
+
+def load_manifest(path):
+    '''
+    Load the page manifest written by `extract_intermediate(incremental=True)`;
+    it maps every page title to its revision id, the sha1 of its text, and the intermediate files it contributed to.
+    '''
+    manifest = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fin:
+            for line in fin:
+                entry = json.loads(line)
+                manifest[entry.pop('title')] = entry
+    return manifest
 
 
-def extract_intermediate(dumpfile, *, intermediate_dir='intermediate', allow_spaces=True, max_iterations:int=None):
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'wt', encoding='utf-8') as fout:
+        for title, entry in manifest.items():
+            fout.write(json.dumps(dict(title=title, **entry), ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def remove_records(intermediate_dir, paths, titles):
+    '''
+    Remove the records whose source word is in `titles` from the intermediate files `paths`.
+    The files (and language directories) that are left empty are deleted, and their paths are returned.
+    '''
+    deleted = set()
+    for relpath in sorted(paths):
+        path = os.path.join(intermediate_dir, relpath)
+        if not os.path.exists(path):
+            continue
+        num_kept = 0
+        with open(path, encoding='utf-8') as fin:
+            with open(path + '.tmp', 'wt', encoding='utf-8') as fout:
+                for line in fin:
+                    if json.loads(line)['srcs'][0] not in titles:
+                        fout.write(line)
+                        num_kept += 1
+        if num_kept:
+            os.replace(path + '.tmp', path)
+        else:
+            os.remove(path + '.tmp')
+            os.remove(path)
+            deleted.add(relpath)
+            dirpath = os.path.dirname(path)
+            if not os.listdir(dirpath):
+                os.rmdir(dirpath)
+    return deleted
+
+
+def _extract_incremental(dumpfile, intermediate_dir, allow_spaces, stats):
+    '''
+    Update `intermediate_dir` to a new dump by parsing only the pages that are new or have changed since the last run.
+
+    Pages are compared against the manifest by revision id and the sha1 of their text.
+    The records of changed and deleted pages are removed from the files they were written to,
+    and the records of new and changed pages are appended.
+    The files therefore contain the same records as a full rebuild, but not necessarily in the same order,
+    and files that are left without records are deleted.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> dumpfile = os.path.join(tmpdir, 'dump.xml')
+    >>> def write_dump(pages):
+    ...     with open(dumpfile, 'w') as fout:
+    ...         for i, (title, pos, tgt) in enumerate(pages):
+    ...             _ = fout.write(f'<page>\\n<title>{title}</title>\\n<ns>0</ns>\\n<revision>\\n<id>{i}</id>\\n<text>==Spanish==\\n==={pos}===\\n# [[{tgt}]]</text>\\n</revision>\\n</page>\\n')
+    >>> intermediate_dir = os.path.join(tmpdir, 'intermediate')
+    >>> write_dump([('perro', 'Noun', 'dog'), ('correr', 'Verb', 'run')])
+    >>> _extract_incremental(dumpfile, intermediate_dir, True, ExtractStats())
+    >>> sorted(os.listdir(os.path.join(intermediate_dir, 'Spanish')))
+    ['translations.Noun', 'translations.Verb']
+    >>> write_dump([('perro', 'Noun', 'dog')])
+    >>> _extract_incremental(dumpfile, intermediate_dir, True, ExtractStats())
+    >>> sorted(os.listdir(os.path.join(intermediate_dir, 'Spanish')))
+    ['translations.Noun']
+    >>> [ path for entry in load_manifest(os.path.join(intermediate_dir, '.manifest.jsonl')).values() for path in entry['files'] ]
+    ['Spanish/translations.Noun']
+    '''
+    manifest_path = os.path.join(intermediate_dir, '.manifest.jsonl')
+    old_manifest = load_manifest(manifest_path)
+    if not old_manifest and os.path.isdir(intermediate_dir) and os.listdir(intermediate_dir):
+        raise ValueError(f'{intermediate_dir} has no manifest; incremental extraction must start from an empty directory')
+
+    shard_dir = os.path.join(intermediate_dir, '.shards', 'incremental')
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    manifest = {}
+    stale = set()
+    num_parsed = 0
+    with IntermediateWriter(shard_dir) as writer:
+        for i, (title, text, revision, _) in enumerate(iterate_pages(dumpfile)):
+            sha1 = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            entry = old_manifest.get(title)
+            if entry and entry['revision'] == revision and entry['sha1'] == sha1:
+                manifest[title] = entry
+                continue
+            if entry:
+                stale.add(title)
+            _, parseinfo = process_entry(title, text, allow_spaces=allow_spaces, stats=stats)
+            paths = write_parseinfo(title, parseinfo, writer)
+            manifest[title] = {'revision': revision, 'sha1': sha1, 'files': sorted(set(paths))}
+            num_parsed += 1
+            if i%1000 == 0:
+                logging.info(f'i={i}, num_parsed={num_parsed}, title={title}')
+
+    deleted = old_manifest.keys() - manifest.keys()
+    stale |= deleted
+    logging.info(f'parsed {num_parsed} new or changed pages; removing the old records of {len(stale)} pages ({len(deleted)} deleted)')
+    stale_paths = { path for title in stale for path in old_manifest[title]['files'] }
+    deleted_paths = remove_records(intermediate_dir, stale_paths, stale)
+    merge_shards([shard_dir], intermediate_dir)
+    # there are no shards if no page was parsed
+    shutil.rmtree(os.path.join(intermediate_dir, '.shards'), ignore_errors=True)
+    # a deleted file is written again if a changed page has new records in it
+    deleted_paths = { path for path in deleted_paths if not os.path.exists(os.path.join(intermediate_dir, path)) }
+    if deleted_paths:
+        logging.info(f'deleted {len(deleted_paths)} files that were left without records')
+        for entry in manifest.values():
+            entry['files'] = [ path for path in entry['files'] if path not in deleted_paths ]
+    save_manifest(manifest_path, manifest)
+
+
+def intermediate_file_sizes(intermediate_dir):
+    '''
+    Return the size of every file in the language directories of `intermediate_dir`.
+    '''
+    sizes = {}
+    if os.path.isdir(intermediate_dir):
+        for lang in os.listdir(intermediate_dir):
+            dirpath = os.path.join(intermediate_dir, lang)
+            if lang.startswith('.') or not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                sizes[os.path.join(lang, filename)] = os.path.getsize(os.path.join(dirpath, filename))
+    return sizes
+
+
+def rollback_intermediate(intermediate_dir, sizes):
+    '''
+    Undo everything written to `intermediate_dir` after the file sizes `sizes` were recorded:
+    files are truncated to their recorded size, and files that did not exist are deleted.
+    '''
+    for path, size in intermediate_file_sizes(intermediate_dir).items():
+        if path not in sizes:
+            os.remove(os.path.join(intermediate_dir, path))
+        elif size > sizes[path]:
+            os.truncate(os.path.join(intermediate_dir, path), sizes[path])
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'wt', encoding='utf-8') as fout:
+        fout.write(json.dumps(checkpoint, ensure_ascii=False))
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _extract_serial(dumpfile, intermediate_dir, allow_spaces, languages, max_iterations, stats, checkpoint_every, resume):
+    '''
+    Parse the dump in a single process.
+
+    With `checkpoint_every`, the output files are fsynced every that many pages,
+    and the dump offset of the next page is saved together with the size of every output file.
+    `resume` rolls the output files back to the last checkpoint and continues from its offset,
+    so no record is duplicated or lost;
+    `max_iterations` then counts the pages processed since the checkpoint.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> dumpfile = os.path.join(tmpdir, 'dump.xml')
+    >>> with open(dumpfile, 'w') as fout:
+    ...     for i in range(50):
+    ...         _ = fout.write(f'<page>\\n<title>perro{i}</title>\\n<ns>0</ns>\\n<revision>\\n<id>{i}</id>\\n<text>==Spanish==\\n===Noun===\\n# [[dog]]</text>\\n</revision>\\n</page>\\n')
+    >>> intermediate_dir = os.path.join(tmpdir, 'intermediate')
+    >>> count = lambda: sum(1 for _ in open(os.path.join(intermediate_dir, 'Spanish', 'translations.Noun')))
+    >>> _extract_serial(dumpfile, intermediate_dir, True, None, 10, ExtractStats(), 3, False)
+    >>> count()
+    12
+    >>> _extract_serial(dumpfile, intermediate_dir, True, None, None, ExtractStats(), 3, True)
+    >>> count()
+    50
+    '''
+    checkpoint_path = os.path.join(intermediate_dir, '.checkpoint.json')
+    if resume:
+        if not os.path.exists(checkpoint_path):
+            raise ValueError(f'no checkpoint to resume from in {intermediate_dir}')
+        with open(checkpoint_path, encoding='utf-8') as fin:
+            checkpoint = json.load(fin)
+        if checkpoint['dumpfile'] != os.path.abspath(dumpfile):
+            raise ValueError(f'the checkpoint is for {checkpoint["dumpfile"]}, not {dumpfile}')
+        rollback_intermediate(intermediate_dir, checkpoint['sizes'])
+        stats.merge(ExtractStats.from_json(checkpoint['stats']))
+        logging.info(f'resuming after {checkpoint["pages"]} pages at offset {checkpoint["offset"]}')
+    else:
+        checkpoint = {
+            'dumpfile': os.path.abspath(dumpfile),
+            'offset': 0,
+            'pages': 0,
+            'sizes': intermediate_file_sizes(intermediate_dir),
+            }
+
+    def save(offset, pages):
+        writer.sync()
+        for path in writer.touched:
+            checkpoint['sizes'][os.path.relpath(path, intermediate_dir)] = os.path.getsize(path)
+        snapshot = ExtractStats().merge(stats)
+        snapshot.recurse_cache_hits += recurse_cache.hits
+        snapshot.recurse_cache_misses += recurse_cache.misses
+        checkpoint.update(offset=offset, pages=pages, stats=snapshot.to_json())
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    # the checkpoints update checkpoint['pages'], so the start is kept for max_iterations
+    start_pages = checkpoint['pages']
+    finished = True
+    with IntermediateWriter(intermediate_dir) as writer:
+        for i, (title, text, _, end) in enumerate(iterate_pages(dumpfile, checkpoint['offset']), start=checkpoint['pages']):
+            _, parseinfo = process_entry(title, text, allow_spaces=allow_spaces, languages=languages, stats=stats)
+            write_parseinfo(title, parseinfo, writer)
+            if i%1000 == 0:
+                logging.info(f'i={i}, title={title}')
+
+            if checkpoint_every and (i+1)%checkpoint_every == 0:
+                save(end, i+1)
+
+            if max_iterations and i-start_pages>max_iterations:
+                finished = False
+                break
+
+        if checkpoint_every or resume:
+            if finished:
+                writer.sync()
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
+            else:
+                save(end, i+1)
+
+
+def extract_intermediate(dumpfile, *, intermediate_dir='intermediate', allow_spaces=True, max_iterations:int=None, workers:int=1, languages=None, incremental=False, stats_path=None, checkpoint_every:int=None, resume=False):
     '''
     Extract a wiktionary dump file into a machine-readable intermediate form.
     
     :dumpfile: path to the wiktionary dump file
     :intermediate_dir: location to store the parsed results
     :max_iterations: stop processing after this many entries; this is useful for debugging since it greatly lowers the runtime
+    :workers: number of processes to parse with;
+        each process parses byte ranges of the dump into its own shard, and the shards are merged in dump order afterwards,
+        so the output is identical to a serial run
+    :languages: comma separated names of the languages to extract (e.g. `German,Korean`);
+        pages and sections of other languages are skipped, which makes rebuilding a few languages much faster
+    :incremental: only parse the pages that are new or changed since the previous incremental run,
+        and remove the records of changed and deleted pages;
+        the revision id and content hash of every page are stored in `<intermediate_dir>/.manifest.jsonl`
+    :stats_path: save the parsing statistics as json to this path
+    :checkpoint_every: fsync the output and save a checkpoint to `<intermediate_dir>/.checkpoint.json` every this many pages
+    :resume: continue an interrupted run from its last checkpoint;
+        anything written after the checkpoint is removed first, and `max_iterations` counts from the checkpoint
     '''
-    for i, (title,text) in enumerate(iterate(dumpfile)):
-        _, parseinfo = process_entry(title, text, allow_spaces=allow_spaces)
-        for lang in parseinfo.keys():
-            for pos in parseinfo[lang].keys():
-                if pos and lang:
-                    for parsekey,parseval in parseinfo[lang][pos].items():
-                        if parseval:
-                            try:
-                                dirpath = os.path.join(intermediate_dir, lang)
-                                os.makedirs(dirpath, exist_ok=True)
-                                path = os.path.join(dirpath, parsekey+'.'+pos)
-                                with open(path, 'at', encoding='utf-8') as fout:
-                                    json_dump = json.dumps({'srcs': [title], 'tgts': list(parseval.keys())}, ensure_ascii = False)
-                                    fout.write(json_dump + '\n')
-                            except FileNotFoundError as e:
-                                logging.error(f'{e}')
-        if i%1000 == 0:
-            logging.info(f'i={i}, title={title}')
-
-        if max_iterations and i>max_iterations:
-            break
-
-    print('Found Templates:')
-    for k,v in list(sorted(template_names.items(), reverse=True, key=lambda x: x[1]))[:20]:
-        print(f'  {k:30} - {v:8}')
+    if languages is not None:
+        languages = frozenset(language.strip() for language in languages.split(','))
+
+    stats = ExtractStats()
+    recurse_cache.hits = recurse_cache.misses = 0
+
+    if incremental:
+        if workers > 1 or max_iterations or languages or checkpoint_every or resume:
+            raise ValueError('incremental is not supported together with workers, max_iterations, languages or checkpoints')
+        _extract_incremental(dumpfile, intermediate_dir, allow_spaces, stats)
+
+    elif workers > 1:
+        if max_iterations or checkpoint_every or resume:
+            raise ValueError('max_iterations and checkpoints are only supported when workers=1')
+        shards_dir = os.path.join(intermediate_dir, '.shards')
+        shutil.rmtree(shards_dir, ignore_errors=True)
+        offsets = chunk_offsets(dumpfile, 4*workers)
+        shard_dirs = [ os.path.join(shards_dir, f'{k:04}') for k in range(len(offsets)) ]
+        jobs = [ (dumpfile, start, end, shard_dir, allow_spaces, languages) for (start, end), shard_dir in zip(offsets, shard_dirs) ]
+        with multiprocessing.Pool(workers) as pool:
+            for chunk_stats in pool.imap(_extract_chunk, jobs):
+                stats.merge(chunk_stats)
+        logging.info('merging shards')
+        merge_shards(shard_dirs, intermediate_dir)
+        shutil.rmtree(shards_dir)
 
-    print('Unkown Templates:')
-    for k,v in list(sorted(unknown_template_names.items(), reverse=True, key=lambda x: x[1]))[:200]:
-        print(f'  {k:30} - {v:8}')
-
-    print("len(bad_pages)=",len(bad_pages))
-    print("len(bad_langwords)=",len(bad_langwords))
-    print("len(good_pages)=",len(good_pages))
-    print("len(good_langwords)=",len(good_langwords))
-    print("len(found_glosses)=",len(found_glosses))
+    else:
+        _extract_serial(dumpfile, intermediate_dir, allow_spaces, languages, max_iterations, stats, checkpoint_every, resume)
+
+    if workers <= 1:
+        stats.recurse_cache_hits += recurse_cache.hits
+        stats.recurse_cache_misses += recurse_cache.misses
+    stats.report()
+    if stats_path:
+        with open(stats_path, 'wt', encoding='utf-8') as fout:
+            fout.write(stats.to_json() + '\n')
 
 
 if __name__ == '__main__':
@@ -1,53 +1,120 @@
 #!/usr/bin/python3
 
+import functools
+import glob
 import logging
+import multiprocessing
+import os
 
+import sys
+sys.path.append('src')
+from rank_index import vec_words
 
-def fraction_present(word_vector_path, bli_path, *, tgt_vectors_path=None, max_vocab=200000, print_every=10000):
 
-    logging.info(f'loading {bli_path}')
-    srcs = []
+def load_srcs(bli_path):
+    srcs = set()
     with open(bli_path) as fin:
         for line in fin:
             src = line.split()[0]
-            srcs.append(src)
-    srcs_set = set(srcs)
+            srcs.add(src)
+    return srcs
+
+
+def count_present(word_vector_path, srcs_set, tgts_set, max_vocab=200000, print_every=None):
+    '''
+    Return the number of words of `word_vector_path` that are read,
+    the number of them that are sources in the BLI dataset,
+    and the number of the others that are in the English vocabulary `tgts_set`.
+    '''
+    num_words = 0
+    words_in_bli = 0
+    words_in_tgt = 0
+    for i, word in enumerate(vec_words(word_vector_path, max_vocab if max_vocab > 0 else None), start=1):
+        num_words = i
+        if word in srcs_set:
+            words_in_bli += 1
+        elif word in tgts_set:
+            words_in_tgt += 1
+        if print_every and i % print_every == 0:
+            logging.info(f'i={i}, words_in_bli/i={words_in_bli/i:0.4f} (words_in_bli+words_in_tgt)/i={(words_in_bli+words_in_tgt)/i:0.4f}')
+    return num_words, words_in_bli, words_in_tgt
+
+
+def fraction_present(word_vector_path, bli_path, *, tgt_vectors_path=None, max_vocab=200000, print_every=10000):
+
+    logging.info(f'loading {bli_path}')
+    srcs_set = load_srcs(bli_path)
 
     tgts_set = set()
     if tgt_vectors_path:
         logging.info(f'loading {tgt_vectors_path}')
-        with open(tgt_vectors_path) as fin:
-            for i, line in enumerate(fin):
-                if max_vocab > 0 and i >= max_vocab:
-                    break
-                word = line.split()[0]
-                tgts_set.add(word)
+        tgts_set.update(vec_words(tgt_vectors_path, max_vocab if max_vocab > 0 else None))
 
     logging.info(f'loading {word_vector_path}')
-    words = []
-    words_not_in_bli = []
-    words_in_bli = 0
-    words_in_tgt = 0
-    with open(word_vector_path) as fin:
-        for i, line in enumerate(fin):
-            if max_vocab > 0 and i > max_vocab:
-                break
-            word = line.split()[0]
-            words.append(word)
-            if word in srcs_set:
-                words_in_bli += 1
-            elif word in tgts_set:
-                words_in_tgt += 1
-            else:
-                words_not_in_bli.append(word)
-            if i % print_every == 0 and i != 0:
-                logging.info(f'i={i}, words_in_bli/i={words_in_bli/i:0.4f} (words_in_bli+words_in_tgt)/i={(words_in_bli+words_in_tgt)/i:0.4f}')
-
-    #for i, word in enumerate(words_not_in_bli[:1000]):
-        #logging.debug(f'word {i:06} not in bli is {word}')
+    count_present(word_vector_path, srcs_set, tgts_set, max_vocab, print_every)
+
+
+# the English vocabulary is loaded once by the main process and given to the workers by `_init_worker`;
+# forked workers share it instead of copying it
+tgts_set = set()
+
+
+def _init_worker(tgts):
+    global tgts_set
+    tgts_set = tgts
+
+
+def _language_row(job, max_vocab):
+    langiso, word_vector_path, bli_path = job
+    num_words, words_in_bli, words_in_tgt = count_present(word_vector_path, load_srcs(bli_path), tgts_set, max_vocab)
+    return langiso, num_words, words_in_bli, words_in_tgt
+
+
+def fraction_present_all(final_dir='final', *, split='all', vec_dir='/home/mizbicki/proj/korean/models', tgt_vectors_path='/home/mizbicki/proj/korean/models/crawl-300d-2M.vec', max_vocab=200000, numpar:int=1, output=None):
+    '''
+    Print the fraction of the words of every language's vectors that are in its BLI dataset, as one table.
+
+    :final_dir: the directory with the `<lang>-en.<split>` datasets
+    :split: the dataset split to compare with, e.g. all or test
+    :vec_dir: the directory with the `cc.<lang>.300.vec` files
+    :tgt_vectors_path: the English `.vec` file; its vocabulary is loaded once for all languages
+    :max_vocab: number of words of each `.vec` file to read
+    :numpar: number of languages to process in parallel
+    :output: also write the table to this tab separated file
+    '''
+    global tgts_set
+    if tgt_vectors_path:
+        logging.info(f'loading {tgt_vectors_path}')
+        tgts_set = set(vec_words(tgt_vectors_path, max_vocab if max_vocab > 0 else None))
+
+    jobs = []
+    for bli_path in sorted(glob.glob(os.path.join(final_dir, f'*-en.{split}'))):
+        langiso = os.path.basename(bli_path)[:-len(f'-en.{split}')]
+        word_vector_path = os.path.join(vec_dir, f'cc.{langiso}.300.vec')
+        if not os.path.exists(word_vector_path):
+            logging.warning(f'skipping {langiso}: {word_vector_path} does not exist')
+            continue
+        jobs.append((langiso, word_vector_path, bli_path))
+    logging.info(f'computing the fractions of {len(jobs)} languages')
+
+    count = functools.partial(_language_row, max_vocab=max_vocab)
+    if numpar > 1:
+        with multiprocessing.Pool(numpar, initializer=_init_worker, initargs=(tgts_set,)) as pool:
+            rows = list(pool.imap(count, jobs))
+    else:
+        rows = [ count(job) for job in jobs ]
+
+    lines = ['langiso\tnum_words\twords_in_bli\twords_in_tgt\tfraction_in_bli\tfraction_in_bli_or_tgt']
+    for langiso, num_words, words_in_bli, words_in_tgt in rows:
+        num_words_ = max(num_words, 1)
+        lines.append(f'{langiso}\t{num_words}\t{words_in_bli}\t{words_in_tgt}\t{words_in_bli/num_words_:0.4f}\t{(words_in_bli+words_in_tgt)/num_words_:0.4f}')
+    print('\n'.join(lines))
+    if output:
+        with open(output, 'wt', encoding='utf-8') as fout:
+            fout.write('\n'.join(lines) + '\n')
 
 
 if __name__ == '__main__':
     import clize
     logging.basicConfig(level=logging.DEBUG)
-    clize.run(fraction_present)
+    clize.run(fraction_present, alt=[fraction_present_all])
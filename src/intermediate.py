@@ -0,0 +1,355 @@
+'''
+Readers and writers for the intermediate files produced by `extract.py`.
+
+The intermediate directory contains one subdirectory per language,
+and each subdirectory contains files named `<parsekey>.<pos>` (e.g. `translations.Noun`).
+Every record of a file has the form `{"srcs": [...], "tgts": [...]}`.
+
+`extract.py` writes the files with one json record per line.
+They can be converted to a compact binary format with
+
+    $ python3 src/intermediate.py intermediate
+
+The binary format stores every distinct string once in a string table,
+and each record as a range of string ids in two id arrays,
+so that a file can be memory mapped and read without parsing any json.
+A binary file keeps its original name; readers recognize it by its first bytes.
+Programs that read the intermediate files should use `read_records` and `count_records`,
+which understand both formats.
+The extraction only appends json lines,
+so a directory has to be converted back with `--to jsonl` before it is extracted into again;
+appending to a binary file raises a ValueError.
+'''
+
+import os
+import sys
+import json
+import logging
+from array import array
+from collections import OrderedDict, defaultdict
+
+sys.path.append('src')
+from binfile import MappedFile, write_array, has_magic
+
+
+class IntermediateWriter:
+    '''
+    Append lines to the files of an intermediate directory.
+
+    Opening, appending to, and closing a file for every record is very slow on a full dump.
+    Instead, lines are buffered per output file and written in large blocks,
+    and up to `max_open` files are kept open at once (the least recently used file is closed when another is needed).
+    Directories that have already been created are remembered so that `os.makedirs` is called once per language.
+
+    The writer should be used as a context manager so that all buffers get flushed
+    when the extraction finishes, fails, or is interrupted.
+
+    Files in the binary format cannot be appended to:
+
+    >>> import tempfile
+    >>> intermediate_dir = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(intermediate_dir, 'Spanish'))
+    >>> write_binary(os.path.join(intermediate_dir, 'Spanish', 'translations.Noun'), [{'srcs': ['perro'], 'tgts': ['dog']}])
+    >>> try:
+    ...     with IntermediateWriter(intermediate_dir) as writer:
+    ...         writer.write('Spanish', 'translations.Noun', '{"srcs": ["can"], "tgts": ["dog"]}\\n')
+    ... except ValueError as e:
+    ...     print(str(e).replace(intermediate_dir, '<dir>'))
+    <dir>/Spanish/translations.Noun is in the binary format; convert the directory back with `python3 src/intermediate.py <dir> --to jsonl` before extracting into it
+    '''
+
+    def __init__(self, intermediate_dir, *, max_open=256, buffer_size=2**16, max_buffered=2**26):
+        '''
+        :intermediate_dir: the directory to write into
+        :max_open: maximum number of simultaneously open files
+        :buffer_size: a file's buffer is written once it contains this many characters
+        :max_buffered: all buffers are written once they contain this many characters in total
+        '''
+        self.intermediate_dir = intermediate_dir
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.handles = OrderedDict()
+        self.buffers = defaultdict(list)
+        self.buffered = defaultdict(int)
+        self.total_buffered = 0
+        self.dirs = set()
+        self.touched = set()
+        self.unsynced = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, lang, filename, line):
+        '''
+        Append `line` to the file `<intermediate_dir>/<lang>/<filename>`.
+        '''
+        path = os.path.join(self.intermediate_dir, lang, filename)
+        self.buffers[path].append(line)
+        self.buffered[path] += len(line)
+        self.total_buffered += len(line)
+        if self.buffered[path] >= self.buffer_size:
+            self.flush(path)
+        elif self.total_buffered >= self.max_buffered:
+            self.flush_all()
+
+    def flush(self, path):
+        '''
+        Write the buffered lines of `path` to disk.
+        '''
+        lines = self.buffers.pop(path, None)
+        if not lines:
+            return
+        self.total_buffered -= self.buffered.pop(path)
+        try:
+            self._open(path).write(''.join(lines))
+        except FileNotFoundError as e:
+            logging.error(f'{e}')
+            return
+        self.touched.add(path)
+        self.unsynced.add(path)
+
+    def flush_all(self):
+        for path in list(self.buffers.keys()):
+            self.flush(path)
+
+    def sync(self):
+        '''
+        Flush all buffers and fsync every file written since the last call,
+        so that everything written so far survives a crash.
+        '''
+        self.flush_all()
+        for path in self.unsynced:
+            fout = self.handles.get(path)
+            if fout is not None:
+                fout.flush()
+                os.fsync(fout.fileno())
+            else:
+                fd = os.open(path, os.O_RDONLY)
+                os.fsync(fd)
+                os.close(fd)
+        self.unsynced.clear()
+
+    def close(self):
+        self.flush_all()
+        for fout in self.handles.values():
+            fout.close()
+        self.handles.clear()
+
+    def _open(self, path):
+        fout = self.handles.get(path)
+        if fout is not None:
+            self.handles.move_to_end(path)
+            return fout
+        dirpath = os.path.dirname(path)
+        if dirpath not in self.dirs:
+            os.makedirs(dirpath, exist_ok=True)
+            self.dirs.add(dirpath)
+        if path not in self.touched:
+            check_appendable(path)
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        fout = open(path, 'at', encoding='utf-8')
+        self.handles[path] = fout
+        return fout
+
+
+# the binary format: the magic bytes, then the header (5 uint64 values), then the sections
+#
+#   string_offsets  uint64[num_strings+1]  byte offsets of the strings in string_data
+#   src_offsets     uint64[num_records+1]  record i has the sources src_ids[src_offsets[i]:src_offsets[i+1]]
+#   tgt_offsets     uint64[num_records+1]  record i has the targets tgt_ids[tgt_offsets[i]:tgt_offsets[i+1]]
+#   src_ids         uint32[num_srcs]
+#   tgt_ids         uint32[num_tgts]
+#   string_data     utf-8
+#
+# see `binfile.py` for the alignment and byte order of the sections
+BINARY_MAGIC = b'WKTBLI\x00\x01'
+
+
+def write_binary(path, records):
+    '''
+    Write `records` (dicts with the keys `srcs` and `tgts`) to `path` in the binary format.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'translations.Noun')
+    >>> write_binary(path, [{'srcs': ['perro'], 'tgts': ['dog', 'hound']}, {'srcs': ['can'], 'tgts': ['dog']}])
+    >>> is_binary(path), count_records(path)
+    (True, 2)
+    >>> list(read_records(path))
+    [{'srcs': ['perro'], 'tgts': ['dog', 'hound']}, {'srcs': ['can'], 'tgts': ['dog']}]
+    '''
+    string_ids = {}
+    src_offsets = array('Q', [0])
+    tgt_offsets = array('Q', [0])
+    src_ids = array('I')
+    tgt_ids = array('I')
+    for record in records:
+        for word in record['srcs']:
+            src_ids.append(string_ids.setdefault(word, len(string_ids)))
+        for word in record['tgts']:
+            tgt_ids.append(string_ids.setdefault(word, len(string_ids)))
+        src_offsets.append(len(src_ids))
+        tgt_offsets.append(len(tgt_ids))
+
+    string_offsets = array('Q', [0])
+    string_data = []
+    for word in string_ids:
+        string_data.append(word.encode('utf-8'))
+        string_offsets.append(string_offsets[-1] + len(string_data[-1]))
+
+    header = array('Q', [len(src_offsets)-1, len(string_ids), len(src_ids), len(tgt_ids), string_offsets[-1]])
+    with open(path, 'wb') as fout:
+        fout.write(BINARY_MAGIC)
+        for values in [header, string_offsets, src_offsets, tgt_offsets, src_ids, tgt_ids]:
+            write_array(fout, values)
+        fout.write(b''.join(string_data))
+
+
+class BinaryRecords:
+    '''
+    A memory mapped intermediate file in the binary format.
+
+    Records are available by index or by iterating over the object;
+    the strings are only decoded when they are accessed.
+    '''
+
+    def __init__(self, path):
+        self.file = MappedFile(path, BINARY_MAGIC)
+        self.num_records, num_strings, num_srcs, num_tgts, _ = self.file.read_array('Q', 5)
+        self.string_offsets = self.file.read_array('Q', num_strings+1)
+        self.src_offsets = self.file.read_array('Q', self.num_records+1)
+        self.tgt_offsets = self.file.read_array('Q', self.num_records+1)
+        self.src_ids = self.file.read_array('I', num_srcs)
+        self.tgt_ids = self.file.read_array('I', num_tgts)
+        self.string_data = self.file.read_bytes()
+        self.strings = {}
+
+    def string(self, i):
+        word = self.strings.get(i)
+        if word is None:
+            word = str(self.string_data[self.string_offsets[i]:self.string_offsets[i+1]], 'utf-8')
+            self.strings[i] = word
+        return word
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.num_records:
+            raise IndexError(i)
+        return {
+            'srcs': [ self.string(j) for j in self.src_ids[self.src_offsets[i]:self.src_offsets[i+1]] ],
+            'tgts': [ self.string(j) for j in self.tgt_ids[self.tgt_offsets[i]:self.tgt_offsets[i+1]] ],
+            }
+
+    def __iter__(self):
+        for i in range(self.num_records):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def is_binary(path):
+    '''
+    Return True if the intermediate file `path` is in the binary format.
+    '''
+    return has_magic(path, BINARY_MAGIC)
+
+
+def check_appendable(path):
+    '''
+    Raise a ValueError if the intermediate file `path` exists in the binary format,
+    since json lines appended to it would be ignored by the readers.
+    '''
+    if os.path.exists(path) and is_binary(path):
+        intermediate_dir = os.path.dirname(os.path.dirname(path))
+        raise ValueError(f'{path} is in the binary format; convert the directory back with `python3 src/intermediate.py {intermediate_dir} --to jsonl` before extracting into it')
+
+
+def read_records(path):
+    '''
+    Yield the records of the intermediate file `path` in either format.
+    '''
+    if is_binary(path):
+        with BinaryRecords(path) as records:
+            yield from records
+    else:
+        with open(path, encoding='utf-8') as fin:
+            for line in fin:
+                yield json.loads(line)
+
+
+def count_records(path, block_size=2**20):
+    '''
+    Return the number of records in the intermediate file `path` in either format.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'translations.Noun')
+    >>> with open(path, 'w') as fout:
+    ...     _ = fout.write('{"srcs": ["perro"], "tgts": ["dog"]}\\n{"srcs": ["gato"], "tgts": ["cat"]}')
+    >>> count_records(path), count_records(path, block_size=4)
+    (2, 2)
+    '''
+    if is_binary(path):
+        with open(path, 'rb') as fin:
+            fin.seek(len(BINARY_MAGIC))
+            return int.from_bytes(fin.read(8), 'little')
+    # count the newlines in large blocks instead of splitting the file into lines
+    num_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as fin:
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+    # a last line without a newline is a record too
+    return num_lines + (last != b'\n')
+
+
+def convert(intermediate_dir, *, to='binary'):
+    '''
+    Convert every file of an intermediate directory in place to another format;
+    files that are already in the requested format are left alone.
+
+    :intermediate_dir: the directory created by `extract.py`
+    :to: either `binary` or `jsonl`
+    '''
+    if to not in ['binary', 'jsonl']:
+        raise ValueError(f'unknown format {to}')
+    for lang in sorted(os.listdir(intermediate_dir)):
+        dirpath = os.path.join(intermediate_dir, lang)
+        if lang.startswith('.') or not os.path.isdir(dirpath):
+            continue
+        logging.info(f'converting {lang}')
+        for filename in os.listdir(dirpath):
+            path = os.path.join(dirpath, filename)
+            if is_binary(path) == (to == 'binary'):
+                continue
+            records = list(read_records(path))
+            if to == 'binary':
+                write_binary(path + '.tmp', records)
+            else:
+                with open(path + '.tmp', 'wt', encoding='utf-8') as fout:
+                    for record in records:
+                        fout.write(json.dumps(record, ensure_ascii=False) + '\n')
+            os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run(convert)
@@ -0,0 +1,194 @@
+'''
+Persistent word→rank indexes of fastText `.vec` files.
+
+The rank of a word is the number of the line it appears on,
+so the frequency rank of the words in a `.vec` file is known without loading any vectors.
+Scanning a multi-gigabyte `.vec` file just for these ranks takes minutes;
+instead, the ranks can be indexed once with
+
+    $ python3 src/rank_index.py /home/mizbicki/proj/korean/models/crawl-300d-2M.vec
+
+which writes the index `crawl-300d-2M.vec.rank` next to the `.vec` file.
+The index is memory mapped, so it opens in milliseconds and only the pages that are used get read.
+It records the size and modification time of the `.vec` file,
+and an index whose `.vec` file has changed is considered stale and ignored.
+
+The index file contains the magic bytes, the header (5 uint64 values), and the sections
+
+    string_offsets  uint64[num_words+1]  byte offsets of the first word of every line in string_data
+    slots           uint32[num_slots]    a `binfile.hash_table` of the line numbers
+    string_data     utf-8
+'''
+
+import os
+import sys
+import logging
+from array import array
+
+sys.path.append('src')
+from binfile import MappedFile, write_array, has_magic, hash_table, hash_lookup
+from utils import read_vocab, vec_header
+
+RANK_INDEX_MAGIC = b'WKTRANK\x02'
+
+
+def default_index_path(vec_path):
+    return vec_path + '.rank'
+
+
+def _source_stat(vec_path):
+    stat = os.stat(vec_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index(vec_path, *, index_path=None):
+    '''
+    Index the first word of every line of a `.vec` file.
+
+    When a word appears on several lines, the last one determines its rank,
+    exactly like `to_bli_dataset.load_rank_from_vec`.
+
+    :vec_path: the fastText `.vec` file
+    :index_path: where to write the index; defaults to the `.vec` path with `.rank` appended
+    '''
+    index_path = index_path or default_index_path(vec_path)
+    source_size, source_mtime_ns = _source_stat(vec_path)
+
+    logging.info(f'reading {vec_path}')
+    words = [ word.encode('utf-8') for word in read_vocab(vec_path, skip_header=False) ]
+    has_header = vec_header(vec_path) is not None
+
+    logging.info(f'hashing {len(words)} words')
+    slots = hash_table(words)
+
+    string_offsets = array('Q', [0])
+    for word in words:
+        string_offsets.append(string_offsets[-1] + len(word))
+
+    header = array('Q', [len(words), len(slots), source_size, source_mtime_ns, has_header])
+    with open(index_path + '.tmp', 'wb') as fout:
+        fout.write(RANK_INDEX_MAGIC)
+        for values in [header, string_offsets, slots]:
+            write_array(fout, values)
+        fout.write(b''.join(words))
+    os.replace(index_path + '.tmp', index_path)
+    logging.info(f'wrote {index_path}')
+
+
+class RankIndex:
+    '''
+    A memory mapped rank index.
+
+    It behaves like the dictionary returned by `to_bli_dataset.load_rank_from_vec`,
+    and also gives the words of the `.vec` file in order.
+
+    >>> import tempfile
+    >>> vec_path = os.path.join(tempfile.mkdtemp(), 'example.vec')
+    >>> with open(vec_path, 'w') as fout:
+    ...     _ = fout.write('4 2\\nthe 0.1 0.2\\nof 0.3 0.4\\nthé 0.5 0.6\\nof 0.7 0.8\\n')
+    >>> build_index(vec_path)
+    >>> ranks = open_index(vec_path)
+    >>> ranks.get('the'), ranks.get('thé'), ranks['of'], ranks.get('cat', -1), 'cat' in ranks
+    (1, 3, 4, -1, False)
+    >>> len(ranks), list(ranks.words(maxn=2)), list(ranks.words(maxn=2, skip_header=False))
+    (5, ['the', 'of'], ['4', 'the'])
+
+    An index is pickled as its path, so that it can be passed to other processes:
+
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(ranks)).get('of')
+    4
+    >>> ranks.close()
+    '''
+
+    def __init__(self, index_path):
+        self.path = index_path
+        self.file = MappedFile(index_path, RANK_INDEX_MAGIC)
+        self.num_words, num_slots, self.source_size, self.source_mtime_ns, self.has_header = self.file.read_array('Q', 5)
+        self.string_offsets = self.file.read_array('Q', self.num_words+1)
+        self.slots = self.file.read_array('I', num_slots)
+        self.string_start = self.file.offset
+
+    def _word_bytes(self, i):
+        return self.file.mmap[self.string_start+self.string_offsets[i]:self.string_start+self.string_offsets[i+1]]
+
+    def word(self, i):
+        '''
+        Return the first word of line `i` of the `.vec` file.
+        '''
+        return self._word_bytes(i).decode('utf-8')
+
+    def words(self, maxn=None, *, skip_header=True):
+        '''
+        Yield the first word of every line of the `.vec` file, like `utils.read_vocab`.
+        '''
+        start = 1 if skip_header and self.has_header else 0
+        end = self.num_words if maxn is None else min(start+maxn, self.num_words)
+        for i in range(start, end):
+            yield self.word(i)
+
+    def get(self, word, default=None):
+        rank = hash_lookup(self.slots, word.encode('utf-8', 'surrogatepass'), self._word_bytes)
+        return default if rank is None else rank
+
+    def __getitem__(self, word):
+        rank = self.get(word)
+        if rank is None:
+            raise KeyError(word)
+        return rank
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __len__(self):
+        return self.num_words
+
+    def __reduce__(self):
+        return (RankIndex, (self.path,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def open_index(vec_path, index_path=None):
+    '''
+    Return the `RankIndex` of `vec_path`,
+    or None if there is no index or the index is stale.
+    '''
+    index_path = index_path or default_index_path(vec_path)
+    if not os.path.exists(index_path):
+        return None
+    if not has_magic(index_path, RANK_INDEX_MAGIC):
+        logging.warning(f'{index_path} has an unknown format; rebuild it with `python3 src/rank_index.py {vec_path}`')
+        return None
+    index = RankIndex(index_path)
+    if (index.source_size, index.source_mtime_ns) != _source_stat(vec_path):
+        logging.warning(f'{index_path} is stale; rebuild it with `python3 src/rank_index.py {vec_path}`')
+        index.close()
+        return None
+    return index
+
+
+def vec_words(vec_path, maxn=None):
+    '''
+    Yield the words of `vec_path` in order like `utils.read_vocab`,
+    using the rank index if it is up to date.
+    '''
+    index = open_index(vec_path)
+    if index is not None:
+        with index:
+            yield from index.words(maxn)
+    else:
+        yield from read_vocab(vec_path, maxn)
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run(build_index)
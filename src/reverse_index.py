@@ -0,0 +1,270 @@
+'''
+A persistent inverted index from English words to their translations in an intermediate directory.
+
+`reverse_translate.reverse_translate` has to read every translations file to answer a single query.
+Instead, the intermediate directory can be indexed once with
+
+    $ python3 src/reverse_index.py intermediate
+
+which writes the index `intermediate/.reverse_index`.
+The index is memory mapped, so a lookup only reads the few pages that it needs.
+It records the size and modification time of every translations file,
+and an index whose files have changed (or been added or removed) is considered stale and ignored.
+
+The index file contains the magic bytes, the header (5 uint64 values), and the sections
+
+    file_stats       uint64[2*num_files]     the size and mtime_ns of every indexed file
+    file_names       uint32[2*num_files]     the string ids of the language and the POS of every file
+    string_offsets   uint64[num_strings+1]   byte offsets of the strings in string_data
+    target_ids       uint32[num_targets]     the string id of every English target
+    slots            uint32[num_slots]       a `binfile.hash_table` of the targets
+    posting_offsets  uint64[num_targets+1]   target i has the postings posting_offsets[i]:posting_offsets[i+1]
+    posting_files    uint32[num_postings]    the file of every posting
+    posting_words    uint32[num_postings]    the string id of the source word of every posting
+    string_data      utf-8
+
+The files are numbered in the sorted order of their paths,
+and the postings of a target are in the order of the files and of the records within the files,
+so lookups return the words in the same order as scanning the files.
+'''
+
+import os
+import sys
+import glob
+import logging
+import fnmatch
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.append('src')
+from binfile import MappedFile, write_array, has_magic, hash_table, hash_lookup
+from intermediate import read_records
+
+REVERSE_INDEX_MAGIC = b'WKTREV\x00\x01'
+
+
+def default_index_path(intermediate_dir):
+    return os.path.join(intermediate_dir, '.reverse_index')
+
+
+def translation_paths(intermediate_dir, pos='*'):
+    '''
+    Return the sorted paths of the translations files of the POS `pos` (a glob pattern) in `intermediate_dir`.
+    '''
+    return sorted(glob.glob(os.path.join(intermediate_dir, '*/translations.' + pos)))
+
+
+def pos_matches(file_pos, pos):
+    '''
+    Return True if `reverse_translate.reverse_translate` reads the translations file of the POS `file_pos`
+    when it is asked for the POS `pos` (a glob pattern); asking for nouns includes the proper nouns.
+
+    >>> pos_matches('Noun', '*'), pos_matches('Proper noun', 'Noun'), pos_matches('Verb', 'Noun')
+    (True, True, False)
+    '''
+    return fnmatch.fnmatchcase(file_pos, pos) or (pos == 'Noun' and file_pos == 'Proper noun')
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _to_array(typecode, values):
+    ret = array(typecode)
+    ret.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return ret
+
+
+def build_index(intermediate_dir, *, index_path=None):
+    '''
+    Index the translations files of an intermediate directory.
+
+    :intermediate_dir: the directory created by `extract.py`, in either format of `intermediate.py`
+    :index_path: where to write the index; defaults to `<intermediate_dir>/.reverse_index`
+    '''
+    index_path = index_path or default_index_path(intermediate_dir)
+    string_ids = {}
+    target_numbers = {}
+    file_stats = array('Q')
+    file_names = array('I')
+    posting_targets = array('I')
+    posting_files = array('I')
+    posting_words = array('I')
+    paths = translation_paths(intermediate_dir)
+    for file_id, path in enumerate(paths):
+        logging.debug(f'path={path}')
+        file_stats.extend(_file_stat(path))
+        lang = os.path.basename(os.path.dirname(path))
+        pos = os.path.basename(path)[len('translations.'):]
+        file_names.append(string_ids.setdefault(lang, len(string_ids)))
+        file_names.append(string_ids.setdefault(pos, len(string_ids)))
+        for record in read_records(path):
+            word, = record['srcs']
+            word_id = string_ids.setdefault(word, len(string_ids))
+            # a record is found once even if it lists a target several times
+            for tgt in dict.fromkeys(record['tgts']):
+                tgt_id = string_ids.setdefault(tgt, len(string_ids))
+                posting_targets.append(target_numbers.setdefault(tgt_id, len(target_numbers)))
+                posting_files.append(file_id)
+                posting_words.append(word_id)
+    logging.info(f'indexed {len(posting_targets)} postings of {len(target_numbers)} targets in {len(paths)} files')
+
+    # group the postings by target, keeping their order
+    targets = np.frombuffer(posting_targets, dtype=np.uint32) if posting_targets else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(targets, kind='stable')
+    posting_offsets = np.zeros(len(target_numbers)+1, dtype=np.uint64)
+    np.cumsum(np.bincount(targets, minlength=len(target_numbers)), out=posting_offsets[1:])
+
+    strings = [ string.encode('utf-8', 'surrogatepass') for string in string_ids ]
+    string_offsets = array('Q', [0])
+    for string in strings:
+        string_offsets.append(string_offsets[-1] + len(string))
+    target_ids = array('I', target_numbers.keys())
+    slots = hash_table([ strings[i] for i in target_ids ])
+
+    header = array('Q', [len(paths), len(target_ids), len(posting_targets), len(strings), len(slots)])
+    with open(index_path + '.tmp', 'wb') as fout:
+        fout.write(REVERSE_INDEX_MAGIC)
+        for values in [
+                header,
+                file_stats,
+                file_names,
+                string_offsets,
+                target_ids,
+                slots,
+                _to_array('Q', posting_offsets),
+                _to_array('I', np.frombuffer(posting_files, dtype=np.uint32)[order] if posting_files else []),
+                _to_array('I', np.frombuffer(posting_words, dtype=np.uint32)[order] if posting_words else []),
+                ]:
+            write_array(fout, values)
+        fout.write(b''.join(strings))
+    os.replace(index_path + '.tmp', index_path)
+    logging.info(f'wrote {index_path}')
+
+
+class ReverseIndex:
+    '''
+    A memory mapped reverse translation index.
+
+    >>> import tempfile, json
+    >>> intermediate_dir = tempfile.mkdtemp()
+    >>> for lang, pos, records in [
+    ...         ('Spanish', 'Noun', [(['perro'], ['dog', 'hound']), (['can'], ['dog', 'dog'])]),
+    ...         ('Spanish', 'Proper noun', [(['Perro'], ['Dog', 'dog'])]),
+    ...         ('German', 'Noun', [(['Hund'], ['dog'])]),
+    ...         ]:
+    ...     os.makedirs(os.path.join(intermediate_dir, lang), exist_ok=True)
+    ...     with open(os.path.join(intermediate_dir, lang, 'translations.' + pos), 'w') as fout:
+    ...         for srcs, tgts in records:
+    ...             _ = fout.write(json.dumps({'srcs': srcs, 'tgts': tgts}) + '\\n')
+    >>> build_index(intermediate_dir)
+    >>> index = open_index(intermediate_dir)
+    >>> index.lookup('dog')
+    {'German': ['Hund'], 'Spanish': ['perro', 'can', 'Perro']}
+    >>> index.lookup('dog', 'Proper noun'), index.lookup('hound', 'Verb'), index.lookup('cat')
+    ({'Spanish': ['Perro']}, {}, {})
+    >>> index.close()
+    '''
+
+    def __init__(self, index_path):
+        self.file = MappedFile(index_path, REVERSE_INDEX_MAGIC)
+        num_files, num_targets, num_postings, num_strings, num_slots = self.file.read_array('Q', 5)
+        self.file_stats = self.file.read_array('Q', 2*num_files)
+        self.file_names = self.file.read_array('I', 2*num_files)
+        self.string_offsets = self.file.read_array('Q', num_strings+1)
+        self.target_ids = self.file.read_array('I', num_targets)
+        self.slots = self.file.read_array('I', num_slots)
+        self.posting_offsets = self.file.read_array('Q', num_targets+1)
+        self.posting_files = self.file.read_array('I', num_postings)
+        self.posting_words = self.file.read_array('I', num_postings)
+        self.string_start = self.file.offset
+        self.num_files = num_files
+        self.file_matches = {}
+
+    def _string_bytes(self, i):
+        return self.file.mmap[self.string_start+self.string_offsets[i]:self.string_start+self.string_offsets[i+1]]
+
+    def string(self, i):
+        return self._string_bytes(i).decode('utf-8', 'surrogatepass')
+
+    def file_lang_pos(self, file_id):
+        return self.string(self.file_names[2*file_id]), self.string(self.file_names[2*file_id+1])
+
+    def matches(self, file_id, pos):
+        '''
+        Return True if the file `file_id` would be read by `reverse_translate.reverse_translate` for the POS `pos`.
+        '''
+        key = (file_id, pos)
+        match = self.file_matches.get(key)
+        if match is None:
+            _, file_pos = self.file_lang_pos(file_id)
+            match = pos_matches(file_pos, pos)
+            self.file_matches[key] = match
+        return match
+
+    def lookup(self, target, pos='*'):
+        '''
+        Return a dictionary from languages to the words that translate to the English word `target`,
+        exactly like `reverse_translate.reverse_translate`.
+        '''
+        ret = defaultdict(lambda: [])
+        i = hash_lookup(self.slots, target.encode('utf-8', 'surrogatepass'), lambda j: self._string_bytes(self.target_ids[j]))
+        if i is not None:
+            for j in range(self.posting_offsets[i], self.posting_offsets[i+1]):
+                file_id = self.posting_files[j]
+                if self.matches(file_id, pos):
+                    lang, _ = self.file_lang_pos(file_id)
+                    ret[lang].append(self.string(self.posting_words[j]))
+        return dict(ret)
+
+    def is_current(self, intermediate_dir):
+        '''
+        Return True if the translations files of `intermediate_dir` are exactly the files that were indexed.
+        '''
+        paths = translation_paths(intermediate_dir)
+        if len(paths) != self.num_files:
+            return False
+        for file_id, path in enumerate(paths):
+            lang, pos = self.file_lang_pos(file_id)
+            if path != os.path.join(intermediate_dir, lang, 'translations.' + pos):
+                return False
+            if _file_stat(path) != (self.file_stats[2*file_id], self.file_stats[2*file_id+1]):
+                return False
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def open_index(intermediate_dir, index_path=None):
+    '''
+    Return the `ReverseIndex` of `intermediate_dir`,
+    or None if there is no index or the index is stale.
+    '''
+    index_path = index_path or default_index_path(intermediate_dir)
+    if not os.path.exists(index_path):
+        return None
+    if not has_magic(index_path, REVERSE_INDEX_MAGIC):
+        logging.warning(f'{index_path} has an unknown format; rebuild it with `python3 src/reverse_index.py {intermediate_dir}`')
+        return None
+    index = ReverseIndex(index_path)
+    if not index.is_current(intermediate_dir):
+        logging.warning(f'{index_path} is stale; rebuild it with `python3 src/reverse_index.py {intermediate_dir}`')
+        index.close()
+        return None
+    return index
+
+
+if __name__ == '__main__':
+    import clize
+    logging.basicConfig(level=logging.INFO)
+    clize.run(build_index)
@@ -4,11 +4,24 @@ import logging
 import os
 import simplejson as json
 
+import sys
+sys.path.append('src')
+from intermediate import read_records
+import reverse_index
 
-def reverse_translate(target, pos='*', intermediate_dir='intermediate'):
+
+def reverse_translate(target, pos='*', intermediate_dir='intermediate', use_index=True):
     '''
     Find all non-English translations of a given English target word.
+
+    If `intermediate_dir` has an up to date index built by `reverse_index.py`,
+    the translations are looked up in the index instead of scanning every translations file.
     '''
+    if use_index:
+        index = reverse_index.open_index(intermediate_dir)
+        if index is not None:
+            with index:
+                return index.lookup(target, pos)
     ret = defaultdict(lambda: [])
     paths = sorted(glob.glob(os.path.join(intermediate_dir, '*/translations.' + pos)))
     if pos == 'Noun':
@@ -16,16 +29,68 @@ def reverse_translate(target, pos='*', intermediate_dir='intermediate'):
     for path in paths:
         logging.debug(f'path={path}')
         lang = os.path.basename(os.path.dirname(path))
-        with open(path) as fin:
-            for i,line in enumerate(fin):
-                line_parsed = json.loads(line)
-                word, = line_parsed['srcs']
-                tgts = line_parsed['tgts']
-                if target in tgts:
-                    ret[lang].append(word)
+        for record in read_records(path):
+            word, = record['srcs']
+            tgts = record['tgts']
+            if target in tgts:
+                ret[lang].append(word)
     return dict(ret)
 
 
+def read_queries(fin):
+    '''
+    Yield the `(word, pos)` queries of the lines of `fin`;
+    a line is either a word or a word and a POS separated by a tab.
+
+    >>> import io
+    >>> list(read_queries(io.StringIO('dog\\nrun\\tVerb\\n\\nred\\tAdj*\\n')))
+    [('dog', '*'), ('run', 'Verb'), ('red', 'Adj*')]
+    '''
+    for line in fin:
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        word, _, pos = line.partition('\t')
+        yield word, pos or '*'
+
+
+def reverse_translate_batch(queries, intermediate_dir='intermediate', use_index=True):
+    '''
+    Answer many `reverse_translate` queries at once.
+    `queries` is a sequence of `(target, pos)` pairs,
+    and the returned list has the translations of every query in the same order.
+
+    With an up to date index, every query is looked up in the index.
+    Otherwise, every translations file is read once for all of the queries,
+    and only the queried targets and their translations are kept in memory.
+    '''
+    if use_index:
+        index = reverse_index.open_index(intermediate_dir)
+        if index is not None:
+            with index:
+                return [ index.lookup(target, pos) for target, pos in queries ]
+
+    results = [ defaultdict(lambda: []) for _ in queries ]
+    queries_of_target = defaultdict(lambda: [])
+    for i, (target, pos) in enumerate(queries):
+        queries_of_target[target].append((i, pos))
+    poses = { pos for _, pos in queries }
+    for path in reverse_index.translation_paths(intermediate_dir):
+        lang = os.path.basename(os.path.dirname(path))
+        file_pos = os.path.basename(path)[len('translations.'):]
+        matching_poses = { pos for pos in poses if reverse_index.pos_matches(file_pos, pos) }
+        if not matching_poses:
+            continue
+        logging.debug(f'path={path}')
+        for record in read_records(path):
+            word, = record['srcs']
+            for tgt in set(record['tgts']):
+                for i, pos in queries_of_target.get(tgt, ()):
+                    if pos in matching_poses:
+                        results[i][lang].append(word)
+    return [ dict(result) for result in results ]
+
+
 if __name__ == '__main__':
     import os
     import argparse
@@ -33,15 +98,31 @@ if __name__ == '__main__':
     parser.add_argument('--intermediate_dir', default='output.en')
     parser.add_argument('--outdir', default=None)
     parser.add_argument('--pos', default='*')
-    parser.add_argument('word')
+    parser.add_argument('--no_index', action='store_true', help='scan the translations files even if there is an index')
+    parser.add_argument('--batch', default=None, help='a file (or - for stdin) of words to translate, one per line, optionally followed by a tab and a POS; the results are printed as JSON lines')
+    parser.add_argument('word', nargs='?')
     args = parser.parse_args()
+    if (args.word is None) == (args.batch is None):
+        parser.error('give either a word or --batch')
 
     logging.basicConfig(
         level=logging.DEBUG,
         format='%(asctime)s.%(msecs)03d : %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
-    ret = reverse_translate(args.word, args.pos, args.intermediate_dir)
+    if args.batch:
+        if args.batch == '-':
+            queries = list(read_queries(sys.stdin))
+        else:
+            with open(args.batch, encoding='utf-8') as fin:
+                queries = list(read_queries(fin))
+        logging.info(f'len(queries)={len(queries)}')
+        results = reverse_translate_batch(queries, args.intermediate_dir, use_index=not args.no_index)
+        for (word, pos), ret in zip(queries, results):
+            print(json.dumps({'word': word, 'pos': pos, 'translations': ret}, sort_keys=True, ensure_ascii=False))
+        sys.exit(0)
+
+    ret = reverse_translate(args.word, args.pos, args.intermediate_dir, use_index=not args.no_index)
     if args.outdir:
         os.makedirs(args.outdir, exist_ok=True)
         outpath = os.path.join(args.outdir, args.word)
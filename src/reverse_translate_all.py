@@ -1,53 +1,245 @@
+import contextlib
 import glob
 from collections import defaultdict, Counter
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import time
+import zlib
+from operator import itemgetter
 import simplejson as json
 
+import sys
+sys.path.append('src')
+from intermediate import read_records
 
-def reverse_translate_all(pos, output_dir, intermediate_dir='intermediate', output='reverse_translations.json'):
+
+def load_translations(path):
+    '''
+    Return the language of the translations file `path`, its number of records,
+    and a dictionary from the English targets of the file to their words in the order they appear.
+    '''
+    lang = os.path.basename(os.path.dirname(path))
+    translations = defaultdict(lambda: [])
+    num_records = 0
+    for record in read_records(path):
+        word, = record['srcs']
+        for tgt in record['tgts']:
+            translations[tgt].append(word)
+        num_records += 1
+    return lang, num_records, dict(translations)
+
+
+def reverse_translate_all(pos, output_dir, intermediate_dir='intermediate', output='reverse_translations.json', numpar=1):
     '''
     Find all non-English translations of all English words.
+
+    The translations files are loaded by `numpar` processes,
+    and their partial mappings are merged in the sorted order of the paths,
+    so the output does not depend on `numpar`.
     '''
     translations = defaultdict(lambda: defaultdict(lambda: []))
     logging.info('loading dictionaries')
-    for path in sorted(glob.glob(os.path.join(intermediate_dir, '*/translations.' + pos))):
-        logging.debug(f'path={path}')
-        lang = os.path.basename(os.path.dirname(path))
-        with open(path) as fin:
-            for i, line in enumerate(fin):
-                line_parsed = json.loads(line)
-                word, = line_parsed['srcs']
-                tgts = line_parsed['tgts']
-                for tgt in tgts:
-                    translations[tgt][lang].append(word)
+    paths = sorted(glob.glob(os.path.join(intermediate_dir, '*/translations.' + pos)))
+    start = time.perf_counter()
+    num_records = 0
+    with contextlib.ExitStack() as stack:
+        if numpar > 1:
+            pool = stack.enter_context(multiprocessing.Pool(numpar))
+            partials = pool.imap(load_translations, paths)
+        else:
+            partials = map(load_translations, paths)
+        for path, (lang, num_records_path, partial) in zip(paths, partials):
+            logging.debug(f'path={path}')
+            for tgt, words in partial.items():
+                translations[tgt][lang].extend(words)
+            num_records += num_records_path
+    elapsed = time.perf_counter() - start
+    logging.info(f'loaded {num_records} records from {len(paths)} files in {elapsed:.1f}s ({num_records/max(elapsed, 1e-9):.0f} records/sec)')
 
     logging.info('saving results')
     with open(output, 'wt', encoding='utf-8') as fout:
         fout.write(json.dumps(translations))
 
 
+def shard_of(target, num_shards):
+    '''
+    Return the shard of the English word `target`;
+    the shard does not depend on python's hash randomization.
+
+    >>> shard_of('dog', 16) == shard_of('dog', 16) < 16
+    True
+    '''
+    return zlib.crc32(target.encode('utf-8', 'surrogatepass')) % num_shards
+
+
+def shard_path(output_dir, shard, num_shards):
+    return os.path.join(output_dir, f'reverse_translations.{shard:0{len(str(num_shards-1))}d}-of-{num_shards}.jsonl')
+
+
+def _write_run(entries, path):
+    '''
+    Write the `(target, lang, word)` entries, sorted by target, to the run file `path`.
+    '''
+    num_entries = 0
+    with open(path, 'wt', encoding='utf-8') as fout:
+        for entry in entries:
+            fout.write(json.dumps(entry) + '\n')
+            num_entries += 1
+    logging.debug(f'wrote {num_entries} entries to {path}')
+    return path
+
+
+def _read_run(path):
+    with open(path, encoding='utf-8') as fin:
+        for line in fin:
+            yield json.loads(line)
+
+
+def _merge_runs(runs, max_runs, new_run_path):
+    '''
+    Merge groups of `max_runs` consecutive runs into new runs until at most `max_runs` runs remain,
+    so that no more than `max_runs` run files are open at a time, and return the remaining runs.
+    Only consecutive runs are merged, so the entries of a target keep the order they were read in.
+    '''
+    if max_runs < 2:
+        raise ValueError(f'max_runs must be at least 2, got {max_runs}')
+    while len(runs) > max_runs:
+        logging.info(f'merging {len(runs)} runs {max_runs} at a time')
+        merged_runs = []
+        for i in range(0, len(runs), max_runs):
+            group = runs[i:i+max_runs]
+            if len(group) == 1:
+                merged_runs.append(group[0])
+                continue
+            merged = heapq.merge(*[ _read_run(run) for run in group ], key=itemgetter(0))
+            merged_runs.append(_write_run(merged, new_run_path()))
+            for run in group:
+                os.remove(run)
+        runs = merged_runs
+    return runs
+
+
+def reverse_translate_all_sharded(pos, output_dir, intermediate_dir='intermediate', *, num_shards=16, memory_budget=1024, max_runs=64):
+    '''
+    Find all non-English translations of all English words without holding them all in memory.
+
+    The `(target, lang, word)` entries are collected until their estimated size reaches `memory_budget` MB,
+    and are then sorted by target and spilled to a run file.
+    The runs are merged, at most `max_runs` at a time, and every target is written as the JSON line
+    `{"target": ..., "translations": {lang: [words]}}` to the shard `shard_of(target, num_shards)` in `output_dir`.
+    Every shard is sorted by target, and the translations are the same as those of `reverse_translate_all`.
+
+    >>> import tempfile
+    >>> intermediate_dir, output_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> for lang, records in [('German', [(['Hund'], ['dog'])]), ('Spanish', [(['perro'], ['dog', 'hound']), (['can'], ['dog'])])]:
+    ...     os.makedirs(os.path.join(intermediate_dir, lang))
+    ...     with open(os.path.join(intermediate_dir, lang, 'translations.Noun'), 'w') as fout:
+    ...         for srcs, tgts in records:
+    ...             _ = fout.write(json.dumps({'srcs': srcs, 'tgts': tgts}) + '\\n')
+    >>> reverse_translate_all_sharded('*', output_dir, intermediate_dir, num_shards=1, memory_budget=0)
+    >>> with open(shard_path(output_dir, 0, 1)) as fin:
+    ...     print(fin.read(), end='')
+    {"target": "dog", "translations": {"German": ["Hund"], "Spanish": ["perro", "can"]}}
+    {"target": "hound", "translations": {"Spanish": ["perro"]}}
+
+    With more runs than `max_runs`, the runs are merged in several passes:
+
+    >>> with open(os.path.join(intermediate_dir, 'Spanish', 'translations.Verb'), 'w') as fout:
+    ...     for i in range(10):
+    ...         _ = fout.write(json.dumps({'srcs': [f'v{i}'], 'tgts': ['dog', f'w{i%3}']}) + '\\n')
+    >>> reverse_translate_all_sharded('*', output_dir, intermediate_dir, num_shards=1, memory_budget=0, max_runs=2)
+    >>> with open(shard_path(output_dir, 0, 1)) as fin:
+    ...     print(fin.read(), end='')
+    {"target": "dog", "translations": {"German": ["Hund"], "Spanish": ["perro", "can", "v0", "v1", "v2", "v3", "v4", "v5", "v6", "v7", "v8", "v9"]}}
+    {"target": "hound", "translations": {"Spanish": ["perro"]}}
+    {"target": "w0", "translations": {"Spanish": ["v0", "v3", "v6", "v9"]}}
+    {"target": "w1", "translations": {"Spanish": ["v1", "v4", "v7"]}}
+    {"target": "w2", "translations": {"Spanish": ["v2", "v5", "v8"]}}
+    >>> os.listdir(output_dir)
+    ['reverse_translations.0-of-1.jsonl']
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix='.runs.', dir=output_dir)
+    run_numbers = itertools.count()
+
+    def new_run_path():
+        return os.path.join(run_dir, f'run.{next(run_numbers):06d}.jsonl')
+
+    try:
+        budget = memory_budget * 2**20
+        runs = []
+        entries = []
+        size = 0
+        num_records = 0
+        start = time.perf_counter()
+        logging.info('loading dictionaries')
+        for path in sorted(glob.glob(os.path.join(intermediate_dir, '*/translations.' + pos))):
+            logging.debug(f'path={path}')
+            lang = os.path.basename(os.path.dirname(path))
+            for record in read_records(path):
+                word, = record['srcs']
+                for tgt in record['tgts']:
+                    entries.append((tgt, lang, word))
+                    # the strings, the tuple, and the list slot of the entry
+                    size += sys.getsizeof(tgt) + sys.getsizeof(word) + 72
+                num_records += 1
+                if size >= budget:
+                    # the sort is stable, so the entries of a target keep the order they were read in
+                    entries.sort(key=itemgetter(0))
+                    runs.append(_write_run(entries, new_run_path()))
+                    entries = []
+                    size = 0
+        if entries:
+            entries.sort(key=itemgetter(0))
+            runs.append(_write_run(entries, new_run_path()))
+            entries = []
+        elapsed = time.perf_counter() - start
+        logging.info(f'loaded {num_records} records in {elapsed:.1f}s ({num_records/max(elapsed, 1e-9):.0f} records/sec)')
+        runs = _merge_runs(runs, max_runs, new_run_path)
+        logging.info(f'merging {len(runs)} runs into {num_shards} shards')
+
+        shards = [ open(shard_path(output_dir, shard, num_shards), 'wt', encoding='utf-8') for shard in range(num_shards) ]
+        try:
+            # heapq.merge takes equal targets from the runs in order, so the words keep the order they were read in
+            merged = heapq.merge(*[ _read_run(run) for run in runs ], key=itemgetter(0))
+            for tgt, group in itertools.groupby(merged, key=itemgetter(0)):
+                translations = defaultdict(lambda: [])
+                for _, lang, word in group:
+                    translations[lang].append(word)
+                line = json.dumps({'target': tgt, 'translations': translations})
+                shards[shard_of(tgt, num_shards)].write(line + '\n')
+        finally:
+            for shard in shards:
+                shard.close()
+    finally:
+        shutil.rmtree(run_dir)
+    logging.info(f'wrote {num_shards} shards to {output_dir}')
+
+
 if __name__ == '__main__':
-    import os
     import argparse
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='find the non-English translations of all English words')
     parser.add_argument('--intermediate_dir', default='output.en')
-    parser.add_argument('--outdir', default=None)
     parser.add_argument('--pos', default='*')
-    parser.add_argument('word')
+    parser.add_argument('--output', default='reverse_translations.json', help='the JSON file of all translations')
+    parser.add_argument('--numpar', type=int, default=1, help='number of processes that load the translations files')
+    parser.add_argument('--sharded_dir', default=None, help='write JSON lines shards to this directory with bounded memory instead of --output')
+    parser.add_argument('--num_shards', type=int, default=16)
+    parser.add_argument('--memory_budget', type=float, default=1024, help='MB of entries to hold in memory before spilling a sorted run (with --sharded_dir)')
+    parser.add_argument('--max_runs', type=int, default=64, help='number of runs to merge at a time (with --sharded_dir)')
     args = parser.parse_args()
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.INFO,
         format='%(asctime)s.%(msecs)03d : %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
-    ret = reverse_translate(args.word, args.pos, args.intermediate_dir)
-    if args.outdir:
-        os.makedirs(args.outdir, exist_ok=True)
-        outpath = os.path.join(args.outdir, args.word)
-        with open(outpath, 'wt', encoding='utf-8') as fout:
-            fout.write(json.dumps(ret, sort_keys=True))
-    print(json.dumps(ret, sort_keys=True, indent=4, ensure_ascii=False))
-    print("len(ret)=",len(ret))
-
+    if args.sharded_dir:
+        reverse_translate_all_sharded(args.pos, args.sharded_dir, args.intermediate_dir, num_shards=args.num_shards, memory_budget=args.memory_budget, max_runs=args.max_runs)
+    else:
+        reverse_translate_all(args.pos, None, args.intermediate_dir, args.output, numpar=args.numpar)
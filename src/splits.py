@@ -0,0 +1,103 @@
+'''
+Assignment of the records of a language to the train and test splits of the BLI datasets.
+
+The records of every POS are sorted by rank, and the split of every record is stored as a code in a numpy array:
+
+    TRAIN       the record is only in the train set
+    TRAINSMALL  the record is in the test set and in the trainsmall set
+    TESTSMALL   the record is in the test set and in the testsmall set
+
+The assignment of a language can be saved together with the record order and the ranks,
+so that its datasets can be audited or written again without the word vectors or a new random sample.
+'''
+
+import hashlib
+
+import numpy as np
+
+TRAIN = 0
+TRAINSMALL = 1
+TESTSMALL = 2
+
+# the splits (and so the dataset files) that a record with each code belongs to
+split_names = {
+    TRAIN: ('train',),
+    TRAINSMALL: ('test', 'trainsmall'),
+    TESTSMALL: ('test', 'testsmall'),
+    }
+
+
+def pos_seed(seed, langiso, pos):
+    '''
+    Return the seed of the random sample of the POS `pos` of the language `langiso`.
+    The seed does not depend on the other languages and POS, or on python's hash randomization.
+
+    >>> pos_seed(0, 'es', 'Noun') == pos_seed(0, 'es', 'Noun') != pos_seed(0, 'es', 'Verb')
+    True
+    '''
+    return int.from_bytes(hashlib.sha256(f'{seed}-{langiso}-{pos}'.encode('utf-8')).digest()[:8], 'little')
+
+
+def assign_splits(num_records, *, maxpos, num_small, num_test, seed):
+    '''
+    Return the split codes of `num_records` records that are sorted by rank.
+
+    The first `num_small` records form the testsmall set.
+    Then `num_test - num_small` records are sampled from the remaining records among the first `maxpos`
+    to complete the test set, and these also form the trainsmall set.
+    All other records are train records.
+
+    >>> codes = assign_splits(10, maxpos=8, num_small=2, num_test=5, seed=0)
+    >>> codes[:2].tolist(), int((codes == TRAINSMALL).sum()), codes[8:].tolist()
+    ([2, 2], 3, [0, 0])
+    >>> bool((codes == assign_splits(10, maxpos=8, num_small=2, num_test=5, seed=0)).all())
+    True
+
+    There are never more test records than records:
+
+    >>> assign_splits(3, maxpos=3, num_small=2, num_test=5, seed=0).tolist()
+    [2, 2, 1]
+    '''
+    maxpos = min(maxpos, num_records)
+    num_small = min(num_small, maxpos)
+    num_samples = max(0, min(maxpos, num_test) - num_small)
+    codes = np.full(num_records, TRAIN, dtype=np.uint8)
+    codes[:num_small] = TESTSMALL
+    rng = np.random.default_rng(seed)
+    codes[num_small + rng.choice(maxpos - num_small, num_samples, replace=False)] = TRAINSMALL
+    return codes
+
+
+def save_splits(path, splits):
+    '''
+    Save the splits of a language to the `.npz` file `path`.
+
+    `splits` maps every POS to a dict with the arrays
+    `order` (the indexes of the records in the intermediate file, sorted by rank),
+    `rank` (the rank of each of these records), and `split` (the split code of each of these records).
+    '''
+    arrays = {}
+    for pos, arrays_pos in splits.items():
+        for name, values in arrays_pos.items():
+            arrays[f'{pos}/{name}'] = values
+    with open(path, 'wb') as fout:
+        np.savez_compressed(fout, **arrays)
+
+
+def load_splits(path):
+    '''
+    Load the splits saved by `save_splits`.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'es.npz')
+    >>> save_splits(path, {'Proper noun': {'order': np.array([1, 0]), 'rank': np.array([3., 7.]), 'split': np.array([2, 0], dtype=np.uint8)}})
+    >>> splits = load_splits(path)
+    >>> list(splits), splits['Proper noun']['order'].tolist(), splits['Proper noun']['split'].tolist()
+    (['Proper noun'], [1, 0], [2, 0])
+    '''
+    splits = {}
+    with np.load(path) as data:
+        for key in data.files:
+            pos, name = key.rsplit('/', 1)
+            splits.setdefault(pos, {})[name] = data[key]
+    return splits
@@ -1,5 +1,8 @@
 import os
+import json
+import logging
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 valid_pos_small = {
         'Adjective'     : 50,
@@ -24,9 +27,79 @@ valid_pos = {
 import sys
 sys.path.append('src')
 from to_bli_dataset import langs_157
+from intermediate import count_records
 langs_157_to_iso = { iso:lang for lang,iso in langs_157.items() }
 
 
+def default_cache_path(output):
+    return os.path.join(output, '.summary_cache.json')
+
+
+def collect_stats(output, conj=False, *, numpar=8, cache_path=None):
+    '''
+    Return a dictionary from the languages of the intermediate directory `output`
+    to a Counter of the number of records of each POS in `valid_pos`
+    (including the conjugations if `conj` is True).
+
+    The files are counted by `numpar` threads, and the counts are saved to `cache_path`
+    (by default `<output>/.summary_cache.json`) together with the size and mtime of each file,
+    so that the next call only counts the files that have changed.
+
+    >>> import tempfile
+    >>> output = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(output, 'Spanish'))
+    >>> with open(os.path.join(output, 'Spanish', 'translations.Noun'), 'w') as fout:
+    ...     _ = fout.write('{"srcs": ["perro"], "tgts": ["dog"]}\\n' * 3)
+    >>> collect_stats(output)
+    {'Spanish': Counter({'Noun': 3})}
+    >>> with open(os.path.join(output, '.summary_cache.json')) as fin:
+    ...     list(json.load(fin).keys())
+    ['Spanish/translations.Noun']
+    '''
+    cache_path = cache_path or default_cache_path(output)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as fin:
+            cache = json.load(fin)
+
+    stats = {}
+    files = []
+    for lang in sorted(os.listdir(output)):
+        lang_path = os.path.join(output, lang)
+        if lang.startswith('.') or not os.path.isdir(lang_path):
+            continue
+        stats[lang] = Counter()
+        for filename in sorted(os.listdir(lang_path)):
+            if filename.startswith('translations.') or (conj and filename.startswith('conjugations.')):
+                pos = filename.split('.')[1]
+                if pos in valid_pos:
+                    files.append((lang, pos, os.path.join(lang, filename)))
+
+    def count(relpath):
+        stat = os.stat(os.path.join(output, relpath))
+        entry = cache.get(relpath)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry, False
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'count': count_records(os.path.join(output, relpath))}, True
+
+    new_cache = {}
+    with ThreadPoolExecutor(numpar) as pool:
+        entries = pool.map(count, [ relpath for _, _, relpath in files ])
+        num_counted = 0
+        for (lang, pos, relpath), (entry, counted) in zip(files, entries):
+            stats[lang][pos] += entry['count']
+            new_cache[relpath] = entry
+            num_counted += counted
+    logging.info(f'counted {num_counted} of {len(files)} files; the others were cached')
+
+    # only rewrite the cache if anything has changed
+    if new_cache != cache:
+        with open(cache_path + '.tmp', 'wt', encoding='utf-8') as fout:
+            json.dump(new_cache, fout)
+        os.replace(cache_path + '.tmp', cache_path)
+    return stats
+
+
 if __name__ == '__main__':
     import os
     import argparse
@@ -35,19 +108,11 @@ if __name__ == '__main__':
     parser.add_argument("--conj", action='store_true')
     parser.add_argument('--max', default=10, type=int)
     parser.add_argument('--outdir', default='../korean/paper/fig')
+    parser.add_argument('--numpar', default=8, type=int, help='number of threads that count the records')
+    parser.add_argument('--cache', default=None, help='the file of cached counts; defaults to OUTPUT/.summary_cache.json')
     args = parser.parse_args()
 
-    stats = {}
-    for lang in os.listdir(args.output):
-        lang_path = os.path.join(args.output, lang)
-        stats[lang] = Counter()
-        for filename in os.listdir(lang_path):
-            if filename.startswith('translations.') or (args.conj and filename.startswith('conjugations.')):
-                pos = filename.split('.')[1]
-                path = os.path.join(lang_path, filename)
-                if pos in valid_pos:
-                    with open(path) as fin:
-                        stats[lang][pos] += len(fin.readlines())
+    stats = collect_stats(args.output, args.conj, numpar=args.numpar, cache_path=args.cache)
 
     totals = [ (lang, sum(stats[lang].values())) for lang in stats.keys() ]
     totals.sort(key=lambda x: x[1], reverse=True)
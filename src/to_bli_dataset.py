@@ -1,10 +1,21 @@
-from collections import defaultdict
-import random
+from collections import defaultdict, Counter
+from operator import itemgetter
+import functools
+import heapq
+import multiprocessing
 import os
 import sys
 import glob
 import math
-import json
+import time
+
+import numpy as np
+
+sys.path.append('src')
+from intermediate import read_records
+from utils import read_vocab
+from splits import TRAIN, split_names, assign_splits, pos_seed, save_splits, load_splits
+import rank_index
 
 import logging
 logging.basicConfig(
@@ -205,15 +216,226 @@ langs_ancient = {
 
 def load_rank_from_vec(path, maxn=None): #200000):
     '''
+    Return a dictionary from the words of the first `maxn` lines of a `.vec` file to their line number.
+    The header line counts as line 0, so that the ranks (and the datasets) do not depend on whether a file has a header.
+    '''
+    return { word:i for i,word in enumerate(read_vocab(path, maxn, skip_header=False)) }
+
+
+def load_rank(path):
+    '''
+    Return a mapping from the words of a `.vec` file to their rank.
+    The persistent index built by `rank_index.py` is used if it is up to date,
+    otherwise the whole file is scanned with `load_rank_from_vec`.
+    '''
+    index = rank_index.open_index(path)
+    if index is not None:
+        return index
+    logging.info(f'no up to date rank index for {path}; scanning the file')
+    return load_rank_from_vec(path)
+
+
+class StageTimer:
+    '''
+    Accumulate the time spent in each stage of a computation.
+    Calling the timer ends the current stage and starts the next one.
+
+    >>> end_stage = StageTimer()
+    >>> end_stage('load'); end_stage('sort'); end_stage('load')
+    >>> list(end_stage.timings.keys())
+    ['load', 'sort']
+    '''
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.start = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] += now - self.start
+        self.start = now
+
+    def __str__(self):
+        return ', '.join(f'{stage}={seconds:.2f}s' for stage, seconds in self.timings.items())
+
+
+class SplitWriter:
+    '''
+    Write the records of one language to all of its dataset files in a single pass.
+
+    `write` normalizes a record once and appends it to every file that it belongs to:
+    the per-POS file and the combined file of each of its splits, and the `.all` file.
+    Every file removes its own duplicates (records with the same source and targets),
+    just like writing each file separately would.
+    The number of records that were dropped from the `.all` file for each reason is counted in `dropped`.
+    '''
+
+    splits = ['train', 'trainsmall', 'test', 'testsmall']
+
+    def __init__(self, outdir, langiso, poss, *, max_defns, rm_src_spaces, rm_tgt_spaces, buffering=2**20):
+        self.max_defns = max_defns
+        self.rm_src_spaces = rm_src_spaces
+        self.rm_tgt_spaces = rm_tgt_spaces
+        self.files = {}
+        self.seen = {}
+        names = [ f'{split}.{pos}' for pos in poss for split in self.splits ] + self.splits + ['all']
+        for name in names:
+            self.files[name] = open(os.path.join(outdir, f'{langiso}-en.{name}'), 'w', buffering=buffering)
+            self.seen[name] = set()
+        self.dropped = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for fout in self.files.values():
+            fout.close()
+
+    def write(self, record, pos, splits):
+        '''
+        Append `record` to the files of the splits `splits` (for the POS `pos`) and to the `.all` file.
+        '''
+        src, = record['srcs']
+        tgts = record['tgts']
+        src = src.strip().lower()
+        dedupline = src + ':' + str(tgts)
+        src_spaces = ' ' in src and self.rm_src_spaces
+        if self.rm_tgt_spaces:
+            tgts = [tgt for tgt in tgts if ' ' not in tgt]
+        if self.max_defns:
+            tgts = tgts[:self.max_defns]
+        lines = ''.join(f'{src}\t{tgt.strip().lower()}\n' for tgt in tgts)
+
+        for name in [ f'{split}.{pos}' for split in splits ] + list(splits) + ['all']:
+            seen = self.seen[name]
+            if dedupline in seen:
+                if name == 'all':
+                    self.dropped['duplicate'] += 1
+            elif src_spaces:
+                if name == 'all':
+                    self.dropped['src_spaces'] += 1
+            else:
+                seen.add(dedupline)
+                self.files[name].write(lines)
+                if name == 'all' and not lines:
+                    self.dropped['tgt_spaces'] += 1
+
+
+# the records that get written are (rank, record, pos, splits) tuples;
+# every record is ranked only once, and comparing only the ranks keeps records with equal ranks in their original order
+by_rank = itemgetter(0)
+
+english_vectors_path = '/home/mizbicki/proj/korean/models/crawl-300d-2M.vec'
+
+# the ranks of the English words are loaded once by the main process and given to the workers by `_init_worker`;
+# forked workers share them instead of loading their own copies
+tgt_ranks = None
+
+
+def _init_worker(ranks):
+    global tgt_ranks
+    tgt_ranks = ranks
+
+
+def build_language(langiso, args):
+    '''
+    Build the datasets of the language `langiso` from the intermediate files in `args.input`
+    and write them to `args.output`.
+    The datasets only depend on `args` and on `langiso`, so languages can be built in any order and in parallel.
     '''
-    words = []
-    with open(path, encoding='utf-8', errors='ignore') as fin:
-        for i,line in enumerate(fin):
-            word = line.split()[0]
-            words.append(word)
-            if maxn and i>maxn:
-                break
-    return { word:i for i,word in enumerate(words) }
+    lang = langs[langiso]
+    logging.debug(f'{langiso}:{lang}')
+    end_stage = StageTimer()
+
+    # the splits can be taken from a previous run instead of ranking and sampling the records again
+    if args.load_splits:
+        saved_splits = load_splits(os.path.join(args.load_splits, f'{langiso}.npz'))
+
+    # loading the ranks is slow;
+    # only do it if needed
+    global tgt_ranks
+    if not args.load_splits:
+        if 'tgt' in args.rank_side and tgt_ranks is None:
+            tgt_ranks = load_rank(english_vectors_path)
+        if 'src' in args.rank_side:
+            logging.debug(f'loading {langiso}:{lang} word vectors')
+            src_ranks = load_rank('/home/mizbicki/proj/korean/models/cc.'+langiso+'.300.vec')
+    end_stage('load_vectors')
+
+    # this helper function computes the rank of a record once, when it is loaded
+    def get_rank(record):
+        unranked = 20000000
+        src_rank = 1
+        tgt_rank = 1
+        if 'src' in args.rank_side:
+            word, = record['srcs']
+            src_rank += src_ranks.get(word, unranked)
+        if 'tgt' in args.rank_side:
+            words = record['tgts']
+            ranks = [ tgt_ranks.get(word, unranked) for word in words ]
+            tgt_rank += sum(ranks) / (len(ranks) + 1e-6)
+        return max([src_rank, tgt_rank])
+
+    # load the words, sort them by rank, and compute the test splits;
+    # see `splits.py` for the meaning of the arrays
+    indirname = os.path.join(args.input, lang)
+    records = {}
+    lang_splits = {}
+    for pos in valid_pos:
+        path = os.path.join(indirname, 'translations.' + pos)
+        records[pos] = list(read_records(path)) if os.path.exists(path) else []
+        end_stage('load')
+        if args.load_splits:
+            empty = {'order': np.zeros(0, dtype=np.int64), 'rank': np.zeros(0), 'split': np.zeros(0, dtype=np.uint8)}
+            lang_splits[pos] = saved_splits.get(pos, empty)
+            if len(lang_splits[pos]['order']) != len(records[pos]):
+                raise ValueError(f'{path} has changed since the splits in {args.load_splits} were saved')
+            continue
+        rank = np.array([ get_rank(record) for record in records[pos] ], dtype=np.float64)
+        end_stage('rank')
+        order = np.argsort(rank, kind='stable')
+        end_stage('sort')
+        factor = args.nounfactor // valid_pos['Noun']
+        split = assign_splits(
+            len(order),
+            maxpos=factor*valid_pos[pos],
+            num_small=valid_pos_small.get(pos, 0),
+            num_test=valid_pos[pos],
+            seed=pos_seed(args.seed, langiso, pos),
+            )
+        lang_splits[pos] = {'order': order, 'rank': rank[order], 'split': split}
+        end_stage('split')
+    if args.save_splits:
+        os.makedirs(args.save_splits, exist_ok=True)
+        save_splits(os.path.join(args.save_splits, f'{langiso}.npz'), lang_splits)
+
+    # every record is labeled with the splits it belongs to,
+    # and the train and the test records of every POS form a stream that is sorted by rank
+    streams = []
+    for pos in valid_pos:
+        train = []
+        test = []
+        for i, rank, split in zip(lang_splits[pos]['order'].tolist(), lang_splits[pos]['rank'].tolist(), lang_splits[pos]['split'].tolist()):
+            entry = (rank, records[pos][i], pos, split_names[split])
+            if split == TRAIN:
+                train.append(entry)
+            else:
+                test.append(entry)
+        streams.append(train)
+        streams.append(test)
+
+    # the combined files are sorted by rank;
+    # merging the streams in this order puts records with equal ranks in the same order as sorting each file would
+    with SplitWriter(args.output, langiso, valid_pos, max_defns=args.max_defns, rm_src_spaces=args.rm_src_spaces, rm_tgt_spaces=args.rm_tgt_spaces) as writer:
+        for rank, record, pos, splits in heapq.merge(*streams, key=by_rank):
+            writer.write(record, pos, splits)
+    end_stage('write')
+    logging.info(f'{langiso}: dropped from {langiso}-en.all: {writer.dropped["duplicate"]} duplicates, {writer.dropped["src_spaces"]} with spaces in the source, {writer.dropped["tgt_spaces"]} with spaces in every target')
+    logging.info(f'{langiso}: {end_stage}')
+    return langiso
 
 
 if __name__ == '__main__':
@@ -226,31 +448,31 @@ if __name__ == '__main__':
     parser.add_argument('--max_defns', type=int, default=3)
     parser.add_argument('--clobber', action='store_true')
     parser.add_argument('--print_langisos', action='store_true')
-    parser.add_argument('--numpar', type=int, default=1)
-    parser.add_argument('--parid', type=int, default=0)
+    parser.add_argument('--numpar', type=int, default=1, help='number of languages to build in parallel')
     parser.add_argument('--nounfactor', type=int, default=10000)
     parser.add_argument('--rank_side', default='tgt', choices=['tgt', 'src', 'srctgt'])
     parser.add_argument('--rm_src_spaces', default=True)
     parser.add_argument('--rm_tgt_spaces', default=True)
+    parser.add_argument('--save_splits', default=None, help='save the split assignment of every language to this directory')
+    parser.add_argument('--load_splits', default=None, help='reuse the split assignments saved with --save_splits instead of ranking and sampling')
     args = parser.parse_args()
 
-    random.seed(args.seed)
-
     # print the ids and quit
     if args.print_langisos:
         for i, langiso in enumerate(langs):
-            #if i % args.numpar == (args.parid-1):
             print(langiso)
         sys.exit(0)
 
     # make the output dir
-    outdirname = args.output
-    os.makedirs(outdirname, exist_ok=True)
+    os.makedirs(args.output, exist_ok=True)
 
     # load the English vectors only if needed
-    if 'tgt' in args.rank_side:
+    if 'tgt' in args.rank_side and not args.load_splits:
         logging.debug('loading English word vectors')
-        tgt_ranks = load_rank_from_vec('/home/mizbicki/proj/korean/models/crawl-300d-2M.vec')
+        end_stage = StageTimer()
+        tgt_ranks = load_rank(english_vectors_path)
+        end_stage('load_vectors')
+        logging.info(f'en: {end_stage}')
 
     # compute the languages we'll be looping over
     if not args.langiso:
@@ -258,111 +480,12 @@ if __name__ == '__main__':
     else:
         langisos = args.langiso
 
-    # loop over the languages
-    for langiso in langisos:
-        lang = langs[langiso]
-        logging.debug(f'{langiso}:{lang}')
-
-        # loading the ranks is slow;
-        # only do it if needed
-        if 'src' in args.rank_side:
-            logging.debug(f'loading {langiso}:{lang} word vectors')
-            src_ranks = load_rank_from_vec('/home/mizbicki/proj/korean/models/cc.'+langiso+'.300.vec')
-
-        # this helper function will be used later as the key for sorting ops
-        def get_rank(line):
-            unranked = 20000000
-            src_rank = 1
-            tgt_rank = 1
-            line_parsed = json.loads(line)
-            if 'src' in args.rank_side:
-                word, = line_parsed['srcs']
-                src_rank += src_ranks.get(word, unranked)
-            if 'tgt' in args.rank_side:
-                words = line_parsed['tgts']
-                ranks = [ tgt_ranks.get(word, unranked) for word in words ]
-                tgt_rank += sum(ranks) / (len(ranks) + 1e-6)
-            return max([src_rank, tgt_rank])
-
-        # load the words
-        indirname = os.path.join(args.input, lang)
-        words = defaultdict(lambda: [])
-        for filename in os.listdir(indirname):
-            if filename.startswith('translations.'):
-                pos = filename[13:]
-                path = os.path.join(indirname, filename)
-                try:
-                    with open(path) as fin:
-                        lines = fin.readlines()
-                        lines.sort(key=get_rank)
-                except FileNotFoundError:
-                    print(f'FileNotFoundError: {path}')
-                words[pos] = lines
-
-        # compute the test splits
-        train = defaultdict(lambda: [])
-        trainsmall = defaultdict(lambda: [])
-        test = defaultdict(lambda: [])
-        testsmall = defaultdict(lambda: [])
-
-        for pos in valid_pos:
-            factor = args.nounfactor // valid_pos['Noun']
-            maxpos = min(factor*valid_pos[pos], len(words[pos]))
-            numsamples = max(0, min(maxpos, valid_pos.get(pos,0))-valid_pos_small.get(pos,0))
-            test_indexes = set(random.sample(range(testsmall.get(pos,0),maxpos), numsamples))
-            for i, line in enumerate(words[pos]):
-                if i < valid_pos_small.get(pos, 0):
-                    testsmall[pos].append(line)
-                    test[pos].append(line)
-                elif i in test_indexes:
-                    trainsmall[pos].append(line)
-                    test[pos].append(line)
-                else:
-                    train[pos].append(line)
-            def write_lines(path, lines):
-                with open(path, 'w') as fout:
-                    deduplines = set()
-                    for line in lines:
-                        line_parsed = json.loads(line)
-                        src, = line_parsed['srcs']
-                        tgts = line_parsed['tgts']
-                        src = src.strip().lower()
-                        dedupline = src + ':' + str(tgts)
-                        if dedupline in deduplines:
-                            continue
-                        if ' ' in src and args.rm_src_spaces:
-                            continue
-                        if args.rm_tgt_spaces:
-                            tgts = [tgt for tgt in tgts if ' ' not in tgt]
-                        deduplines.add(dedupline)
-                        if args.max_defns:
-                            tgts = tgts[:args.max_defns]
-                        for i,tgt in enumerate(tgts):
-                            tgt = tgt.strip().lower()
-                            fout.write(f'{src}\t{tgt}\n')
-            write_lines(os.path.join(outdirname, f'{langiso}-en.train.{pos}'), train[pos])
-            write_lines(os.path.join(outdirname, f'{langiso}-en.trainsmall.{pos}'), trainsmall[pos])
-            write_lines(os.path.join(outdirname, f'{langiso}-en.test.{pos}'), test[pos])
-            write_lines(os.path.join(outdirname, f'{langiso}-en.testsmall.{pos}'), testsmall[pos])
-
-        all_train = []
-        all_trainsmall = []
-        all_test = []
-        all_testsmall = []
-        all = []
-        for pos in valid_pos:
-            all_train.extend(train[pos])
-            all_trainsmall.extend(trainsmall[pos])
-            all_test.extend(test[pos])
-            all_testsmall.extend(testsmall[pos])
-            all.extend(train[pos]+test[pos])
-        all_train.sort(key=get_rank)
-        all_trainsmall.sort(key=get_rank)
-        all_test.sort(key=get_rank)
-        all_testsmall.sort(key=get_rank)
-        all.sort(key=get_rank)
-        write_lines(os.path.join(outdirname, f'{langiso}-en.train'), all_train)
-        write_lines(os.path.join(outdirname, f'{langiso}-en.trainsmall'), all_trainsmall)
-        write_lines(os.path.join(outdirname, f'{langiso}-en.test'), all_test)
-        write_lines(os.path.join(outdirname, f'{langiso}-en.testsmall'), all_testsmall)
-        write_lines(os.path.join(outdirname, f'{langiso}-en.all'), all)
+    # build the languages
+    build = functools.partial(build_language, args=args)
+    if args.numpar > 1:
+        with multiprocessing.Pool(args.numpar, initializer=_init_worker, initargs=(tgt_ranks,)) as pool:
+            for langiso in pool.imap_unordered(build, langisos):
+                logging.info(f'finished {langiso}')
+    else:
+        for langiso in langisos:
+            build(langiso)
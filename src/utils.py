@@ -1,3 +1,4 @@
+from collections import OrderedDict
 
 
 def pair_to_line(srcs, tgts):
@@ -5,6 +6,13 @@ def pair_to_line(srcs, tgts):
     >>> pair_to_line(['feliz', 'felices'], ['happy', 'this, is, a test'])
     'feliz,felices:happy,this\\, is\\, a test'
     '''
+    src_line = ','.join(srcs)
+    tgt_line = ','.join(tgts)
+    # most lines have no characters to escape, which is cheaper to check on the joined words;
+    # the only commas are then the separators
+    if (':' not in src_line and ':' not in tgt_line and '\\' not in src_line and '\\' not in tgt_line
+            and src_line.count(',') + tgt_line.count(',') == len(srcs) + len(tgts) - 2):
+        return src_line + ':' + tgt_line
     return ','.join([escape(src) for src in srcs]) + ':' + ','.join([escape(tgt) for tgt in tgts])
 
 
@@ -13,12 +21,36 @@ def line_to_pair(line):
     >>> line_to_pair('feliz,felices:happy,this\\, is\\, a test')
     [['feliz', 'felices'], ['happy', 'this, is, a test']]
     '''
-    src_line, tgt_line = split_unescape(line, ':')
+    # the escapes are kept until the words are split, so that escaped commas are not split
+    src_line, tgt_line = split_unescape(line, ':', unescape=False)
     srcs = split_unescape(src_line, ',')
     tgts = split_unescape(tgt_line, ',')
     return [srcs, tgts]
 
 
+def lines_to_pairs(fin):
+    r'''
+    Yield the `[srcs, tgts]` pair of every line of the file object `fin`.
+
+    >>> import io
+    >>> list(lines_to_pairs(io.StringIO('feliz:happy\nperro,can:dog\n')))
+    [[['feliz'], ['happy']], [['perro', 'can'], ['dog']]]
+    '''
+    for line in fin:
+        yield line_to_pair(line.rstrip('\n'))
+
+
+def pairs_to_lines(pairs):
+    r'''
+    Yield the line (with its newline) of every `(srcs, tgts)` pair of `pairs`, e.g. for `fout.writelines`.
+
+    >>> list(pairs_to_lines([(['feliz'], ['happy']), (['perro', 'can'], ['dog'])]))
+    ['feliz:happy\n', 'perro,can:dog\n']
+    '''
+    for srcs, tgts in pairs:
+        yield pair_to_line(srcs, tgts) + '\n'
+
+
 def escape(s, badchars=':,\\', escape='\\'):
     r'''
     >>> escape('test')
@@ -28,12 +60,13 @@ def escape(s, badchars=':,\\', escape='\\'):
     >>> escape('test\\test')
     'test\\\\test'
     '''
-    ret = []
-    for c in s:
-        if c in badchars:
-            ret.append(escape)
-        ret.append(c)
-    return ''.join(ret)
+    # the escape character is escaped first, so that the escapes added for the other characters are not escaped again
+    if escape in badchars:
+        s = s.replace(escape, escape + escape)
+    for c in badchars:
+        if c != escape:
+            s = s.replace(c, escape + c)
+    return s
 
 
 # see: https://stackoverflow.com/questions/18092354/python-split-string-without-splitting-escaped-character/21882672#21882672
@@ -50,6 +83,14 @@ def split_unescape(s, delim, escape='\\', unescape=True):
     >>> split_unescape('foo$', ',', '$', unescape=True)
     ['foo$']
     """
+    # strings without escapes are split by str.split;
+    # only escaped strings need the character loop
+    if escape not in s and len(delim) == 1:
+        return s.split(delim)
+    return _split_unescape_chars(s, delim, escape, unescape)
+
+
+def _split_unescape_chars(s, delim, escape='\\', unescape=True):
     ret = []
     current = []
     itr = iter(s)
@@ -71,3 +112,109 @@ def split_unescape(s, delim, escape='\\', unescape=True):
             current.append(ch)
     ret.append(''.join(current))
     return ret
+
+
+class LRUCache:
+    '''
+    A dictionary that holds at most `maxsize` items;
+    the least recently used item is evicted when a new one is added,
+    and `get` counts its hits and misses.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b') is None
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def vec_header(path):
+    '''
+    Return `(num_words, dim)` from the header line of the fastText `.vec` file `path`,
+    or None if the file has no header.
+    '''
+    with open(path, 'rb') as fin:
+        parts = fin.readline().split()
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[0]), int(parts[1])
+    return None
+
+
+def read_vocab(path, maxn=None, *, skip_header=True, block_size=2**22):
+    r'''
+    Yield the word (the first token) of every line of the fastText `.vec` file `path`.
+
+    The file is read in blocks of `block_size` bytes and only the first token of each line is decoded,
+    which is several times faster than splitting every line of 300 floats.
+    At most `maxn` words are yielded, and no more of the file is read than needed for them.
+    The header line is skipped unless `skip_header` is False.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'example.vec')
+    >>> with open(path, 'w') as fout:
+    ...     _ = fout.write('3 2\nthe 0.1 0.2\nthé 0.3 0.4\nof 0.5 0.6')
+    >>> list(read_vocab(path))
+    ['the', 'thé', 'of']
+    >>> list(read_vocab(path, 2, skip_header=False))
+    ['3', 'the']
+    >>> list(read_vocab(path, 2, block_size=4))
+    ['the', 'thé']
+    '''
+    if maxn is not None and maxn <= 0:
+        return
+    count = 0
+    with open(path, 'rb') as fin:
+        if skip_header and vec_header(path) is not None:
+            fin.readline()
+        tail = b''
+        while True:
+            block = fin.read(block_size)
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop() if block else b''
+            for line in lines:
+                parts = line.split(None, 1)
+                if not parts:
+                    continue
+                token = parts[0]
+                if token.isascii():
+                    word = token.decode('ascii')
+                else:
+                    # python splits decoded lines on unicode whitespace too
+                    word = token.decode('utf-8', errors='ignore')
+                    if len(word.split()) != 1:
+                        word = line.decode('utf-8', errors='ignore').split()[0]
+                yield word
+                count += 1
+                if count == maxn:
+                    return
+            if not block:
+                return